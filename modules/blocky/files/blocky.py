@@ -28,7 +28,12 @@ import time
 import sys
 import argparse
 import syslog
-import copy
+import hashlib
+import random
+import bisect
+import tempfile
+import shutil
+import shlex
 
 DEBUG = False
 CONFIG = None
@@ -36,8 +41,12 @@ SYSLOG = None
 MAX_IPTABLES_TRIES = 10
 IPTABLES_EXEC = '/sbin/iptables'
 IP6TABLES_EXEC = '/sbin/ip6tables'
-LAST_UPLOAD = 0
+IPTABLES_RESTORE_EXEC = '/sbin/iptables-restore'
+IP6TABLES_RESTORE_EXEC = '/sbin/ip6tables-restore'
+BAN_COMMENT = 'Banned by Blocky/2.0'
 UPLOAD_FREQUENCY = 180
+UPLOAD_MAX_AGE = 3600 # Re-upload an unchanged ruleset this often, as a heartbeat
+API = None
 
 def getbans(chain = 'INPUT'):
    """ Gets a list of all bans in a chain """
@@ -47,7 +56,7 @@ def getbans(chain = 'INPUT'):
    for i in range(0,MAX_IPTABLES_TRIES):
       out = None
       try:
-         out = subprocess.check_output([IPTABLES_EXEC, '--list', chain, '-n', '--line-numbers'], stderr = subprocess.STDOUT)
+         out = subprocess.check_output([IPTABLES_EXEC, '--list', chain, '-n', '--line-numbers'], stderr = subprocess.STDOUT, universal_newlines = True)
       except subprocess.CalledProcessError as err:
          if 'you must be root' in err.output:
             print("Looks like blocky doesn't have permission to access iptables, giving up completely! (are you running as root?)")
@@ -86,7 +95,7 @@ def getbans(chain = 'INPUT'):
       return banlist
    for i in range(0,MAX_IPTABLES_TRIES):
       try:
-         out = subprocess.check_output([IP6TABLES_EXEC, '--list', chain, '-n', '--line-numbers'], stderr = subprocess.STDOUT)
+         out = subprocess.check_output([IP6TABLES_EXEC, '--list', chain, '-n', '--line-numbers'], stderr = subprocess.STDOUT, universal_newlines = True)
       except subprocess.CalledProcessError as err:
          if 'you must be root' in err.output:
             print("Looks like blocky doesn't have permission to access iptables, giving up completely! (are you running as root?)")
@@ -122,57 +131,13 @@ def getbans(chain = 'INPUT'):
          break
    return banlist
       
-def iptables(ip, action):
-    """ Runs an iptables action on an IP (-A, -C or -D), returns true if
-        succeeded, false otherwise """
-    try:
-        exe = IPTABLES_EXEC
-        if ':' in ip:
-            exe = IP6TABLES_EXEC
-        subprocess.check_call([
-            exe,
-            action, "INPUT",
-            "-s", ip,
-            "-j", "DROP",
-            "-m", "comment",
-            "--comment",
-            "Banned by Blocky/2.0"
-        ], stderr=open(os.devnull, 'wb'))
-    except subprocess.CalledProcessError as err: # iptables error, expected result variant
-        return False
-    except OSError as err:
-        print("%s not found or inaccessible: %s" % (exe, err))
-        return False
-    return True
-   
-
-def ban(ip):
-   """ Bans an IP or CIDR block generically """
-   if iptables(ip, '-A'):
-      return True
-   return False
-
-def unban_line(ip, linenumber, chain = 'INPUT'):
-    """ Unbans an IP or block by line number """
-    if not linenumber:
-      return
-    exe = IPTABLES_EXEC
-    if ':' in ip:
-      exe = IP6TABLES_EXEC
-    if DEBUG:
-      print("Would have removed line %s from %s chain in iptables here..." % (linenumber, chain))
-      return True
-    try:
-        subprocess.check_call([
-            exe,
-            '-D', chain, linenumber
-        ], stderr=open(os.devnull, 'wb'))
-    except subprocess.CalledProcessError as err: # iptables error, expected result variant
-        return False
-    except OSError as err:
-        print("%s not found or inaccessible: %s" % (exe, err))
-        return False
-    return True
+def set_executables(config):
+   """ Lets blocky.yaml point us at other iptables binaries (or fakes) """
+   global IPTABLES_EXEC, IP6TABLES_EXEC, IPTABLES_RESTORE_EXEC, IP6TABLES_RESTORE_EXEC
+   IPTABLES_EXEC = config.get('iptables', IPTABLES_EXEC)
+   IP6TABLES_EXEC = config.get('ip6tables', IP6TABLES_EXEC)
+   IPTABLES_RESTORE_EXEC = config.get('iptables-restore', IPTABLES_RESTORE_EXEC)
+   IP6TABLES_RESTORE_EXEC = config.get('ip6tables-restore', IP6TABLES_RESTORE_EXEC)
 
 def inlist(banlist, ip):
    """ Check if an IP or CIDR is listed in iptables,
@@ -203,6 +168,413 @@ def inlist(banlist, ip):
    return lines
 
 
+class BanIndex(object):
+   """ Index over the networks in a ban list: for each address family and
+   prefix length, a hash of network -> entries (plus the sorted networks, for
+   range scans). Finding the entries that contain an IP/block is then one
+   hash lookup per prefix length in use, and finding the ones inside a block
+   is a bisect per prefix length, rather than a scan of every rule. The
+   sorted networks are built the first time a prefix length is range
+   scanned, and kept up to date from then on. """
+
+   def __init__(self, banlist = None):
+      self.nets = {4: {}, 6: {}}
+      self.sorted = {4: {}, 6: {}}
+      self.verbatim = {}
+      self.order = {}
+      self.seq = 0
+      for entry in banlist or []:
+         self.add(entry)
+
+   def key(self, net):
+      """ Returns (family, prefix length, network bits) for a network """
+      width = 32 if net.version == 4 else 128
+      return net.version, net.prefixlen, net.value >> (width - net.prefixlen)
+
+   def add(self, entry):
+      version, prefixlen, bits = self.key(entry['asNet'])
+      table = self.nets[version].setdefault(prefixlen, {})
+      if bits not in table:
+         keys = self.sorted[version].get(prefixlen)
+         if keys is not None:
+            bisect.insort(keys, bits)
+      table.setdefault(bits, []).append(entry)
+      self.verbatim.setdefault(entry['source'], []).append(entry)
+      self.order[id(entry)] = self.seq
+      self.seq += 1
+
+   def remove(self, entry):
+      version, prefixlen, bits = self.key(entry['asNet'])
+      entries = self.nets[version].get(prefixlen, {}).get(bits, [])
+      if entry in entries:
+         entries.remove(entry)
+         if not entries:
+            del self.nets[version][prefixlen][bits]
+            keys = self.sorted[version].get(prefixlen)
+            if keys is not None:
+               del keys[bisect.bisect_left(keys, bits)]
+      if entry in self.verbatim.get(entry['source'], []):
+         self.verbatim[entry['source']].remove(entry)
+      self.order.pop(id(entry), None)
+
+   def supernets(self, net):
+      """ All entries whose network contains (or equals) net """
+      version, prefixlen, bits = self.key(net)
+      found = []
+      for length, table in self.nets[version].items():
+         if length <= prefixlen:
+            found.extend(table.get(bits >> (prefixlen - length), []))
+      return found
+
+   def subnets(self, net):
+      """ All entries whose network lies within (or equals) net """
+      version, prefixlen, bits = self.key(net)
+      found = []
+      for length, table in self.nets[version].items():
+         if length < prefixlen:
+            continue
+         keys = self.sorted[version].get(length)
+         if keys is None:
+            keys = self.sorted[version][length] = sorted(table)
+         shift = length - prefixlen
+         lo = bits << shift
+         i = bisect.bisect_left(keys, lo)
+         j = bisect.bisect_left(keys, lo + (1 << shift))
+         for k in keys[i:j]:
+            found.extend(table[k])
+      return found
+
+   def inlist(self, ip):
+      """ Same answer as inlist(banlist, ip), without the linear scans:
+      verbatim matches first, then containment matches in list order. """
+      if '/0' in ip: # DO NOT WANT
+         return []
+      lines = list(self.verbatim.get(ip, []))
+      if '/' in ip:
+         others = self.subnets(netaddr.IPNetwork(ip))
+      else:
+         others = [e for e in self.supernets(netaddr.IPNetwork(ip))
+                   if '/' in e['source'] and '/0' not in e['source']]
+      seen = set(id(e) for e in lines)
+      others = [e for e in others if id(e) not in seen]
+      others.sort(key = lambda e: self.order[id(e)])
+      return lines + others
+
+
+class Whitelist(object):
+   """ Whitelisted blocks, merged into sorted, non-overlapping [first, last]
+   address ranges per address family, so checking a ban against the whole
+   whitelist is a bisect instead of a loop over every entry. """
+
+   def __init__(self, blocks = None):
+      self.starts = {4: [], 6: []}
+      self.ends = {4: [], 6: []}
+      self.blocks = {4: [], 6: []} # the original blocks behind each range
+      for block in blocks or []:
+         self.add(block)
+
+   def add(self, block):
+      starts, ends, blocks = self.starts[block.version], self.ends[block.version], self.blocks[block.version]
+      first, last = block.first, block.last
+      # Ranges touching or overlapping the new block get merged into it
+      i = bisect.bisect_left(ends, first - 1)
+      j = bisect.bisect_right(starts, last + 1)
+      members = [block]
+      if i < j:
+         first = min(first, starts[i])
+         last = max(last, ends[j-1])
+         for merged in blocks[i:j]:
+            members += merged
+      starts[i:j] = [first]
+      ends[i:j] = [last]
+      blocks[i:j] = [members]
+
+   def overlaps(self, block):
+      """ Returns a whitelisted block that overlaps block (either contains or
+      is contained by it, as CIDR blocks can't partially overlap), or None """
+      starts = self.starts[block.version]
+      i = bisect.bisect_right(starts, block.last) - 1
+      if i < 0 or self.ends[block.version][i] < block.first:
+         return None
+      for wblock in self.blocks[block.version][i]:
+         if block in wblock or wblock in block:
+            return wblock
+      return None
+
+
+class Firewall(object):
+   """ Our view of the ban chains, plus the bans and unbans queued up this
+   round. apply() writes the queued changes with one iptables-restore run
+   per address family, then lists the chains again (once, rather than
+   after each change). The chains may hold rules getbans() doesn't parse,
+   so we can't work out the new line numbers ourselves. """
+
+   def __init__(self, chains = None):
+      self.chains = chains or ['INPUT']
+      self.refresh()
+
+   def refresh(self):
+      """ (Re)lists the chains from iptables, dropping anything queued """
+      self.relist()
+      self.added = []
+      self.removed = []
+
+   def relist(self):
+      self.rules = []
+      for chain in self.chains:
+         self.rules += getbans(chain)
+      self.index = BanIndex(self.rules)
+
+   def inlist(self, ip):
+      """ Like inlist(), but against the rules as they will be after apply() """
+      return self.index.inlist(ip)
+
+   def ban(self, ip, reason = None):
+      """ Queues a DROP rule for an IP or CIDR block in the INPUT chain.
+      Returns the new entry, or None if it's already covered. """
+      if self.index.inlist(ip):
+         return None
+      net = netaddr.IPNetwork(ip)
+      if net.version == 4:
+         # This is how iptables --list -n shows it
+         source = str(net.ip) if net.prefixlen == 32 else str(net.cidr)
+      else:
+         source = str(net.cidr)
+      entry = {
+         'chain': 'INPUT',
+         'linenumber': None,
+         'action': 'DROP',
+         'protocol': 'all',
+         'option': '--' if net.version == 4 else '---',
+         'source': source,
+         'asNet': netaddr.IPNetwork(source),
+         'destination': '0.0.0.0/0' if net.version == 4 else '::/0',
+         'extensions': '/* %s */' % BAN_COMMENT,
+      }
+      if reason:
+         entry['reason'] = reason
+      self.index.add(entry)
+      self.added.append(entry)
+      return entry
+
+   def unban(self, entry):
+      """ Queues removal of a rule found via inlist() """
+      self.index.remove(entry)
+      if entry in self.added:
+         self.added.remove(entry)
+      elif entry not in self.removed:
+         self.removed.append(entry)
+
+   def restore(self, version, script):
+      """ Feeds a ruleset to iptables-restore without flushing what's there,
+      so either all of it is applied or none of it is. """
+      exe = IPTABLES_RESTORE_EXEC if version == 4 else IP6TABLES_RESTORE_EXEC
+      if DEBUG:
+         print("Would have fed the following to %s here...\n%s" % (exe, script))
+         return True
+      for i in range(0,MAX_IPTABLES_TRIES):
+         try:
+            proc = subprocess.Popen([exe, '--noflush'], stdin = subprocess.PIPE, stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
+         except OSError as err:
+            print("%s not found or inaccessible: %s" % (exe, err))
+            return False
+         out = proc.communicate(script.encode('ascii'))[0].decode('ascii', 'replace')
+         if proc.returncode == 0:
+            return True
+         if 'lock' not in out: # Not a write lock, so trying again won't help
+            syslog.syslog(syslog.LOG_WARNING, "%s failed: %s" % (exe, out.strip()))
+            return False
+         time.sleep(1) # write lock, wait for it to go away
+      return False
+
+   def apply(self):
+      """ Applies the queued bans and unbans, returns the (added, removed)
+      entries that actually made it into iptables. """
+      added = []
+      removed = []
+      restored = False
+      for version in (4, 6):
+         adds = [e for e in self.added if e['asNet'].version == version]
+         dels = [e for e in self.removed if e['asNet'].version == version]
+         if not adds and not dels:
+            continue
+         if version == 6 and not os.path.exists(IP6TABLES_EXEC):
+            syslog.syslog(syslog.LOG_WARNING, "%s not found, dropping %u IPv6 bans and %u unbans!" % (IP6TABLES_EXEC, len(adds), len(dels)))
+            for entry in adds:
+               self.index.remove(entry)
+            for entry in dels:
+               self.index.add(entry)
+            continue
+         restored = True
+         # Delete from the bottom up, so the line numbers stay valid as we go
+         dels.sort(key = lambda e: (e['chain'], int(e['linenumber'])), reverse = True)
+         script = ["*filter"]
+         script += ["-D %s %s" % (e['chain'], e['linenumber']) for e in dels]
+         script += ['-A %s -s %s -j DROP -m comment --comment "%s"' % (e['chain'], e['source'], BAN_COMMENT) for e in adds]
+         script.append("COMMIT")
+         if self.restore(version, "\n".join(script) + "\n"):
+            added += adds
+            removed += dels
+         else:
+            syslog.syslog(syslog.LOG_WARNING, "Could not apply %u bans and %u unbans to ip%stables!" % (len(adds), len(dels), '6' if version == 6 else ''))
+            for entry in adds:
+               self.index.remove(entry)
+            for entry in dels:
+               self.index.add(entry)
+      self.added = []
+      self.removed = []
+      if restored:
+         self.relist()
+      return added, removed
+
+
+class ApiClient(object):
+   """ Talks to the modern blocky API over one keep-alive session. Lists are
+   fetched with If-None-Match/If-Modified-Since, so an unchanged list costs
+   a 304 rather than the whole thing, and our ruleset is only uploaded when
+   it has changed (or hasn't been sent for UPLOAD_MAX_AGE seconds). """
+
+   def __init__(self, apiurl):
+      self.apiurl = apiurl
+      self.session = requests.Session()
+      self.cache = {} # endpoint -> (etag, last-modified, json)
+      self.uploaded_hash = None
+      self.uploaded_at = 0
+      self.stats = {'fetched': 0, 'not_modified': 0, 'uploaded': 0, 'upload_skipped': 0}
+      self.reported = dict(self.stats)
+
+   def get(self, endpoint):
+      """ GETs an endpoint's JSON, reusing our copy if it hasn't changed """
+      headers = {}
+      cached = self.cache.get(endpoint)
+      if cached:
+         if cached[0]:
+            headers['If-None-Match'] = cached[0]
+         if cached[1]:
+            headers['If-Modified-Since'] = cached[1]
+      rv = self.session.get("%s/%s" % (self.apiurl, endpoint), headers = headers, timeout = 60)
+      if rv.status_code == 304 and cached:
+         self.stats['not_modified'] += 1
+         return cached[2]
+      rv.raise_for_status()
+      js = rv.json()
+      self.stats['fetched'] += 1
+      etag = rv.headers.get('ETag')
+      modified = rv.headers.get('Last-Modified')
+      if etag or modified:
+         self.cache[endpoint] = (etag, modified, js)
+      else:
+         self.cache.pop(endpoint, None)
+      return js
+
+   def upload(self, hostname, rules):
+      """ PUTs our iptables rules to /myrules, unless the server already has them """
+      now = time.time()
+      if self.uploaded_at > (now - UPLOAD_FREQUENCY):
+         return False
+      bare = [dict((k, v) for k, v in entry.items() if k != 'asNet') for entry in rules]
+      js = {
+         'hostname': hostname,
+         'iptables': bare
+      }
+      digest = hashlib.sha1(json.dumps(js, sort_keys = True).encode('utf-8')).hexdigest()
+      if digest == self.uploaded_hash and self.uploaded_at > (now - UPLOAD_MAX_AGE):
+         self.stats['upload_skipped'] += 1
+         return False
+      apiurl = "%s/myrules" % self.apiurl
+      try:
+         rv = self.session.put(apiurl, json = js, timeout = 60)
+         print(rv.status_code)
+         if rv.status_code != 200:
+            print(rv.text)
+            raise Exception("Server returned HTTP %u" % rv.status_code)
+         self.uploaded_hash = digest
+         self.uploaded_at = now
+         self.stats['uploaded'] += 1
+         return True
+      except Exception as e:
+         print(e)
+         syslog.syslog(syslog.LOG_WARNING, "Could not send my iptables list to server at %s - server down?" % apiurl)
+         return False
+
+   def report(self):
+      """ What we did since the last report, with totals in brackets """
+      delta = dict((k, v - self.reported[k]) for k, v in self.stats.items())
+      self.reported = dict(self.stats)
+      return "API: %u lists fetched (%u), %u unchanged (%u), %u uploads (%u), %u uploads skipped as unchanged (%u)" % (
+         delta['fetched'], self.stats['fetched'], delta['not_modified'], self.stats['not_modified'],
+         delta['uploaded'], self.stats['uploaded'], delta['upload_skipped'], self.stats['upload_skipped'])
+
+
+class StandinApi(object):
+   """ A local stand-in for the blocky API server, for --selftest. Serves
+   /whitelist and /bans with an ETag and Last-Modified (and 304s to match),
+   takes PUT /myrules and POST /note, and counts what it's asked for. """
+
+   def __init__(self):
+      try:
+         from http.server import HTTPServer, BaseHTTPRequestHandler
+         from socketserver import ThreadingMixIn
+      except ImportError:
+         from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+         from SocketServer import ThreadingMixIn
+      import threading
+      self.lists = {'whitelist': {'whitelist': []}, 'bans': {'bans': []}}
+      self.versions = {'whitelist': 1, 'bans': 1}
+      self.myrules = None
+      self.notes = []
+      self.requests = {}
+      standin = self
+
+      class Handler(BaseHTTPRequestHandler):
+         protocol_version = 'HTTP/1.1'
+         def log_message(self, *args):
+            pass
+         def reply(self, code, body = '', headers = None):
+            body = body.encode('utf-8')
+            self.send_response(code)
+            for k, v in (headers or {}).items():
+               self.send_header(k, v)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+         def count(self):
+            key = "%s %s" % (self.command, self.path.split('/')[-1])
+            standin.requests[key] = standin.requests.get(key, 0) + 1
+         def body(self):
+            return json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8'))
+         def do_GET(self):
+            self.count()
+            name = self.path.split('/')[-1]
+            if name not in standin.lists:
+               return self.reply(404)
+            etag = '"%s-%u"' % (name, standin.versions[name])
+            if self.headers.get('If-None-Match') == etag:
+               return self.reply(304, headers = {'ETag': etag})
+            self.reply(200, json.dumps(standin.lists[name]), {'ETag': etag, 'Content-Type': 'application/json',
+               'Last-Modified': time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime())})
+         def do_PUT(self):
+            self.count()
+            standin.myrules = self.body()
+            self.reply(200, 'OK')
+         def do_POST(self):
+            self.count()
+            standin.notes.append(self.body())
+            self.reply(200, 'OK')
+
+      class Server(ThreadingMixIn, HTTPServer):
+         daemon_threads = True
+
+      self.server = Server(('127.0.0.1', 0), Handler)
+      self.apiurl = "http://127.0.0.1:%u/api" % self.server.server_address[1]
+      thread = threading.Thread(target = self.server.serve_forever)
+      thread.daemon = True
+      thread.start()
+
+   def set(self, name, entries):
+      self.lists[name] = {name: entries}
+      self.versions[name] += 1
+
 def note_ban(me, entry):
    apiurl = "%s/note" % CONFIG['server']['apiurl']
    try:
@@ -233,12 +605,10 @@ def run_legacy_checks():
    """ Runs checks using the legacy blocky UI server (mod_lua) """
    apiurl = CONFIG['server']['legacyurl']
    actions = []
-   mylist = []
    ychains = CONFIG.get('iptables', {}).get('chains')
    chains = ychains if ychains else ['INPUT']
-   for chain in chains:
-      mylist += getbans(chain)
-   print("Found %u bans in iptables" % len(mylist))
+   fw = Firewall(chains)
+   print("Found %u bans in iptables" % len(fw.rules))
    
    try:
       actions = requests.get(apiurl).json()
@@ -246,7 +616,7 @@ def run_legacy_checks():
    except:
       syslog.syslog(syslog.LOG_WARNING, "Could not retrieve blocky actions list from %s - server down??!" % apiurl)
    
-   whitelist = [] # Things we are unbanning, and thus shouldn't just ban right again
+   whitelist = Whitelist() # Things we are unbanning, and thus shouldn't just ban right again
    
    # For each action element, find out what to do, and who to do it to.
    for action in actions:
@@ -266,15 +636,12 @@ def run_legacy_checks():
                      block = netaddr.IPNetwork("%s/128" % ip) # IPv6
                   else:
                      block = netaddr.IPNetwork("%s/32" % ip)  # IPv4
-               whitelist.append(block)
-               found = inlist(mylist, ip)
+               whitelist.add(block)
+               found = fw.inlist(ip)
                if found:
                   entry = found[0]
                   syslog.syslog(syslog.LOG_INFO, "Removing %s from block list (found at line %s as %s)" % (ip, entry['linenumber'], entry['source']))
-                  if not unban_line(ip, found[0]['linenumber']):
-                     syslog.syslog(syslog.LOG_WARNING, "Could not remove ban for %s from iptables!" % ip)
-                  else:
-                     mylist = getbans() # Refresh after action succeeded
+                  fw.unban(entry)
                      
       # Ban request?
       elif 'ip' in action:
@@ -291,65 +658,46 @@ def run_legacy_checks():
                      block = netaddr.IPNetwork("%s/128" % ip) # IPv6
                   else:
                      block = netaddr.IPNetwork("%s/32" % ip)  # IPv4
-               for wblock in whitelist:
-                  if block in wblock or wblock in block:
-                     syslog.syslog(syslog.LOG_WARNING, "%s was requested banned but %s is whitelisted, ignoring ban" % (block, wblock))
-                     banit = False
+               wblock = whitelist.overlaps(block)
+               if wblock:
+                  syslog.syslog(syslog.LOG_WARNING, "%s was requested banned but %s is whitelisted, ignoring ban" % (block, wblock))
+                  banit = False
                if banit:
-                  found = inlist(mylist, ip)
+                  found = fw.inlist(ip)
                   if not found:
                      reason = action.get('reason', "No reason specified")
                      syslog.syslog(syslog.LOG_INFO, "Adding %s to block list; %s" % (ip, reason))
-                     if not ban(ip):
-                        syslog.syslog(syslog.LOG_WARNING, "Could not add ban for %s in iptables!" % ip)
-                     else:
-                        mylist = getbans() # Refresh after action succeeded
+                     fw.ban(ip, reason)
+   
+   # Apply all the changes in one go
+   fw.apply()
                         
 def run_new_checks():
    """ Runs the blocky process using the modern UI server """
-   global LAST_UPLOAD
+   global API
+   if not API or API.apiurl != CONFIG['server']['apiurl']:
+      API = ApiClient(CONFIG['server']['apiurl'])
    
    # First, get our rules and post 'em to the server
-   mylist = []
    ychains = CONFIG.get('iptables', {}).get('chains')
    chains = ychains if ychains else ['INPUT']
-   for chain in chains:
-      mylist += getbans(chain)
+   fw = Firewall(chains)
+   mylist = fw.rules
    print("Found %u bans in iptables" % len(mylist))
-   
-   if LAST_UPLOAD < (time.time() - UPLOAD_FREQUENCY):
-      try:
-         mylistbare = copy.deepcopy(mylist)
-         for el in mylistbare:
-            del el['asNet']
-         js = {
-            'hostname': CONFIG['client']['hostname'],
-            'iptables': mylistbare
-         }
-         apiurl = "%s/myrules" % CONFIG['server']['apiurl']
-         rv = requests.put(apiurl, json = js)
-         print(rv.status_code)
-         assert(rv.status_code == 200)
-         LAST_UPLOAD = time.time()
-      except Exception as e:
-         print(e)
-         print(rv.text)
-         syslog.syslog(syslog.LOG_WARNING, "Could not send my iptables list to server at %s - server down?" % apiurl)
+   API.upload(CONFIG['client']['hostname'], mylist)
 
    # Then, get applicable actions from the server
    whitelist = []
-   whiteblocks = [] # same as above, but as IPNetwork classes
+   whiteblocks = Whitelist() # same as above, but as IPNetwork ranges
    banlist = []
    try:
-      whiteurl = "%s/whitelist" % CONFIG['server']['apiurl']
-      whitelist = requests.get(whiteurl).json()['whitelist']
+      whitelist = API.get('whitelist')['whitelist']
    except:
-      syslog.syslog(syslog.LOG_WARNING, "Could not fetch whitelist entries at %s - server down?" % whiteurl)
+      syslog.syslog(syslog.LOG_WARNING, "Could not fetch whitelist entries at %s/whitelist - server down?" % API.apiurl)
    try:
-      banurl = "%s/bans" % CONFIG['server']['apiurl']
-      banlist = requests.get(banurl).json()['bans']
+      banlist = API.get('bans')['bans']
    except:
-      syslog.syslog(syslog.LOG_WARNING, "Could not fetch whitelist entries at %s - server down?" % banurl)
+      syslog.syslog(syslog.LOG_WARNING, "Could not fetch ban entries at %s/bans - server down?" % API.apiurl)
    
    # First, check if we've banned someone on the whitelist
    for entry in whitelist:
@@ -366,16 +714,12 @@ def run_new_checks():
                   block = netaddr.IPNetwork("%s/128" % ip) # IPv6
                else:
                   block = netaddr.IPNetwork("%s/32" % ip)  # IPv4
-            whiteblocks.append(block)
-            found = inlist(mylist, ip)
+            whiteblocks.add(block)
+            found = fw.inlist(ip)
             if found:
                entry = found[0]
                syslog.syslog(syslog.LOG_INFO, "Removing %s from block list (found at line %s as %s)" % (ip, entry['linenumber'], entry['source']))
-               if not unban_line(ip, entry['linenumber'], chain = entry.get('chain', 'INPUT')):
-                  syslog.syslog(syslog.LOG_WARNING, "Could not remove ban for %s from iptables!" % ip)
-               else:
-                  note_unban(CONFIG['client']['hostname'], found[0])
-                  mylist = getbans() # Refresh after action succeeded
+               fw.unban(entry)
    
    # Then process bans
    for entry in banlist:
@@ -393,24 +737,262 @@ def run_new_checks():
                   block = netaddr.IPNetwork("%s/128" % ip) # IPv6
                else:
                   block = netaddr.IPNetwork("%s/32" % ip)  # IPv4
-            for wblock in whiteblocks:
-               if block in wblock or wblock in block:
-                  syslog.syslog(syslog.LOG_WARNING, "%s was requested banned but %s is whitelisted, ignoring ban" % (block, wblock))
-                  banit = False
+            wblock = whiteblocks.overlaps(block)
+            if wblock:
+               syslog.syslog(syslog.LOG_WARNING, "%s was requested banned but %s is whitelisted, ignoring ban" % (block, wblock))
+               banit = False
             if banit:
-               found = inlist(mylist, ip)
+               found = fw.inlist(ip)
                if not found:
                   reason = entry.get('reason', "No reason specified")
                   syslog.syslog(syslog.LOG_INFO, "Adding %s to block list; %s" % (ip, reason))
-                  if not ban(ip):
-                     syslog.syslog(syslog.LOG_WARNING, "Could not add ban for %s in iptables!" % ip)
-                  else:
-                     mylist = getbans() # Refresh after action succeeded
-                     found = inlist(mylist, ip)
-                     if found: # make sure we have it in iptables now
-                        note_ban(CONFIG['client']['hostname'], found[0])
+                  fw.ban(ip, reason)
+   
+   # Apply all the changes in one go, then tell the server what we did
+   added, removed = fw.apply()
+   for entry in removed:
+      note_unban(CONFIG['client']['hostname'], entry)
+   for entry in added:
+      note_ban(CONFIG['client']['hostname'], entry)
+   syslog.syslog(syslog.LOG_INFO, API.report())
    # All done for this time!
 
+def synthetic_bans(count, seed = 42):
+   """ Fakes a getbans() list: mostly single IPv4s, some /24s and IPv6 """
+   rnd = random.Random(seed)
+   banlist = []
+   for i in range(count):
+      kind = rnd.random()
+      if kind < 0.7:
+         source = "%u.%u.%u.%u" % (rnd.randint(1, 223), rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(1, 254))
+      elif kind < 0.85:
+         source = "%u.%u.%u.0/24" % (rnd.randint(1, 223), rnd.randint(0, 255), rnd.randint(0, 255))
+      elif kind < 0.95:
+         source = "2001:db8:%x:%x::%x/128" % (rnd.randint(0, 65535), rnd.randint(0, 65535), rnd.randint(1, 65535))
+      else:
+         source = "2001:db8:%x:%x::/64" % (rnd.randint(0, 65535), rnd.randint(0, 65535))
+      banlist.append({
+         'chain': 'INPUT',
+         'linenumber': str(i + 1),
+         'action': 'DROP',
+         'protocol': 'all',
+         'option': '--',
+         'source': source,
+         'asNet': netaddr.IPNetwork(source),
+         'destination': '0.0.0.0/0',
+         'extensions': '/* Banned by Blocky/2.0 */',
+      })
+   return banlist
+
+def benchmark(sizes = (1000, 10000, 100000)):
+   """ Replays synthetic ban/whitelist lookups against iptables lists of
+   various sizes, using the old linear inlist() and the BanIndex, then
+   filters 100k bans through a 5k whitelist with and without Whitelist. """
+   for size in sizes:
+      banlist = synthetic_bans(size)
+      # Half the lookups are for listed entries, half for random new ones
+      queries = [e['source'] for e in banlist[:size // 2]] + [e['source'] for e in synthetic_bans(size // 2, seed = 7)]
+      start = time.time()
+      index = BanIndex(banlist)
+      built = time.time() - start
+      start = time.time()
+      hits = sum(1 for ip in queries if index.inlist(ip))
+      indexed = time.time() - start
+      # The linear scan is far too slow to run every query at 100k, so sample
+      sample = queries[::max(1, len(queries) // 200)]
+      start = time.time()
+      for ip in sample:
+         inlist(banlist, ip)
+      linear = (time.time() - start) / len(sample) * len(queries)
+      print("%7u rules, %7u lookups (%u hits): index %.2fs (+%.2fs build), linear ~%.1fs" % (size, len(queries), hits, indexed, built, linear))
+   
+   bans = [e['asNet'] for e in synthetic_bans(100000, seed = 1)]
+   wblocks = [e['asNet'] for e in synthetic_bans(5000, seed = 2)]
+   # Make sure some of the bans actually hit the whitelist
+   bans[::50] = [netaddr.IPNetwork("%s/32" % w.ip) if w.version == 4 else w for w in wblocks[:2000]]
+   start = time.time()
+   whitelist = Whitelist(wblocks)
+   built = time.time() - start
+   start = time.time()
+   hits = sum(1 for block in bans if whitelist.overlaps(block))
+   merged = time.time() - start
+   sample = bans[::500]
+   start = time.time()
+   for block in sample:
+      for wblock in wblocks:
+         if block in wblock or wblock in block:
+            break
+   nested = (time.time() - start) / len(sample) * len(bans)
+   print("%7u bans vs %u whitelist entries (%u whitelisted): ranges %.2fs (+%.2fs build), nested loop ~%.1fs" % (len(bans), len(wblocks), hits, merged, built, nested))
+
+def fake_iptables(args):
+   """ Stands in for iptables/ip6tables and iptables-restore in --selftest:
+   blocky.py --fake-iptables statedir v4|v6 <iptables arguments>. Rules live
+   in statedir/rules-v4.json (chain -> [target, prot, source, dest, extra]),
+   every invocation is appended to statedir/calls.log. """
+   statedir, family, args = args[0], args[1], args[2:]
+   path = os.path.join(statedir, "rules-%s.json" % family)
+   chains = json.load(open(path))
+   stdin = sys.stdin.read() if '--noflush' in args else None
+   with open(os.path.join(statedir, 'calls.log'), 'a') as f:
+      f.write(json.dumps({'family': family, 'args': args, 'stdin': stdin}) + "\n")
+   if '--list' in args:
+      chain = args[args.index('--list') + 1]
+      if chain not in chains:
+         print("iptables: No chain/target/match by that name.")
+         sys.exit(1)
+      print("Chain %s (policy ACCEPT)" % chain)
+      print("num  target     prot opt source               destination")
+      for n, (target, prot, source, dest, extra) in enumerate(chains[chain]):
+         if family == 'v4':
+            print("%-4u %-10s %-4s --  %-20s %-20s %s" % (n + 1, target, prot, source, dest, extra))
+         else:
+            print("%-4u %-10s %-4s     %-39s %-39s %s" % (n + 1, target, prot, source, dest, extra))
+      return
+   # iptables-restore --noflush: all or nothing
+   for line in stdin.splitlines():
+      words = shlex.split(line)
+      if not words or words[0] in ('*filter', 'COMMIT'):
+         continue
+      if words[0] == '-D':
+         rules = chains.get(words[1], [])
+         n = int(words[2])
+         if n < 1 or n > len(rules):
+            print("iptables-restore: line %s failed" % line)
+            sys.exit(1)
+         del rules[n - 1]
+      elif words[0] == '-A':
+         net = netaddr.IPNetwork(words[words.index('-s') + 1])
+         source = str(net.ip) if net.version == 4 and net.prefixlen == 32 else str(net.cidr)
+         dest = '0.0.0.0/0' if net.version == 4 else '::/0'
+         chains.setdefault(words[1], []).append([words[words.index('-j') + 1], 'all', source, dest, '/* %s */' % words[words.index('--comment') + 1]])
+      else:
+         print("iptables-restore: unknown command %s" % words[0])
+         sys.exit(1)
+   json.dump(chains, open(path, 'w'))
+
+def selftest():
+   """ Runs Firewall against fake iptables binaries (see fake_iptables) with
+   chains that mix bans with rules getbans() skips, and checks that line
+   numbers stay right through bans and unbans, and that each apply() costs
+   one iptables-restore per address family. Then runs a few rounds of
+   run_new_checks() against a StandinApi, checking the ETag and upload
+   savings. Returns True if all is well. """
+   global SYSLOG, CONFIG, API, UPLOAD_FREQUENCY
+   statedir = tempfile.mkdtemp()
+   errors = []
+   logged = []
+   original = {'iptables': IPTABLES_EXEC, 'ip6tables': IP6TABLES_EXEC, 'iptables-restore': IPTABLES_RESTORE_EXEC, 'ip6tables-restore': IP6TABLES_RESTORE_EXEC}
+   SYSLOG = syslog.syslog
+   syslog.syslog = lambda prio, msg: logged.append(msg)
+   try:
+      icmp = ['ACCEPT', 'icmp', '0.0.0.0/0', '0.0.0.0/0', 'icmptype 8']
+      ban = lambda ip: ['DROP', 'all', ip, '0.0.0.0/0', '/* %s */' % BAN_COMMENT]
+      json.dump({'INPUT': [icmp, ban('10.0.0.1'), icmp, ban('10.0.0.2'), ban('10.0.0.3')]}, open(os.path.join(statedir, 'rules-v4.json'), 'w'))
+      json.dump({'INPUT': [['ACCEPT', 'icmpv6', '::/0', '::/0', ''], ['DROP', 'all', '2001:db8::1/128', '::/0', '/* %s */' % BAN_COMMENT]]},
+                open(os.path.join(statedir, 'rules-v6.json'), 'w'))
+      executables = {}
+      for name, family in (('iptables', 'v4'), ('ip6tables', 'v6'), ('iptables-restore', 'v4'), ('ip6tables-restore', 'v6')):
+         path = os.path.join(statedir, name)
+         with open(path, 'w') as f:
+            f.write('#!/bin/sh\nexec "%s" "%s" --fake-iptables "%s" %s "$@"\n' % (sys.executable, os.path.abspath(__file__), statedir, family))
+         os.chmod(path, 0o755)
+         executables[name] = path
+      set_executables(executables)
+
+      def calls():
+         with open(os.path.join(statedir, 'calls.log')) as f:
+            return [json.loads(line) for line in f]
+
+      def check(fw, what):
+         """ Every rule we know of must be at the line number we think it's at """
+         for family, version in (('v4', 4), ('v6', 6)):
+            chains = json.load(open(os.path.join(statedir, "rules-%s.json" % family)))
+            bans = [rule[2] for rule in chains['INPUT'] if rule[0] == 'DROP']
+            ours = [e for e in fw.rules if e['asNet'].version == version]
+            if sorted(e['source'] for e in ours) != sorted(bans):
+               errors.append("%s: we have %s in %s, iptables has %s" % (what, [e['source'] for e in ours], family, bans))
+            for entry in ours:
+               n = int(entry['linenumber'])
+               if n > len(chains['INPUT']) or chains['INPUT'][n - 1][2] != entry['source']:
+                  errors.append("%s: %s is not at line %s in %s" % (what, entry['source'], n, family))
+
+      fw = Firewall(['INPUT'])
+      check(fw, "initial listing")
+      before = len(calls())
+      fw.unban(fw.inlist('10.0.0.1')[0])
+      fw.ban('10.0.0.9', 'selftest')
+      fw.ban('2001:db8::2')
+      added, removed = fw.apply()
+      check(fw, "after first apply")
+      restores = [c for c in calls()[before:] if '--noflush' in c['args']]
+      if len(added) != 2 or len(removed) != 1:
+         errors.append("first apply: %u added, %u removed, expected 2 and 1" % (len(added), len(removed)))
+      if sorted(c['family'] for c in restores) != ['v4', 'v6']:
+         errors.append("first apply: expected one iptables-restore per family, got %s" % [c['family'] for c in restores])
+
+      # The new ban sits below rules we don't parse; removing it must hit the right line
+      fw.unban(fw.inlist('10.0.0.9')[0])
+      fw.unban(fw.inlist('10.0.0.3')[0])
+      added, removed = fw.apply()
+      check(fw, "after second apply")
+      chains = json.load(open(os.path.join(statedir, 'rules-v4.json')))
+      if chains['INPUT'].count(icmp) != 2:
+         errors.append("second apply removed rules that weren't ours: %s" % chains['INPUT'])
+
+      # A few rounds against a stand-in API server: lists that haven't changed
+      # must come back as 304s, and an unchanged ruleset mustn't be re-uploaded
+      saved = (CONFIG, API, UPLOAD_FREQUENCY)
+      standin = StandinApi()
+      CONFIG = {'server': {'apiurl': standin.apiurl}, 'client': {'hostname': 'selftest'}}
+      API = None
+      UPLOAD_FREQUENCY = 0
+      try:
+         standin.set('whitelist', [{'ip': '10.0.0.2', 'reason': 'selftest'}])
+         standin.set('bans', [{'ip': '10.0.0.50', 'reason': 'selftest'}])
+         run_new_checks()    # unbans 10.0.0.2, bans 10.0.0.50, uploads
+         run_new_checks()    # lists unchanged, rules changed since last upload
+         run_new_checks()    # nothing changed at all
+         stats = API.stats
+         if (stats['fetched'], stats['not_modified']) != (2, 4):
+            errors.append("API: expected 2 list fetches and 4 not-modifieds, got %(fetched)u and %(not_modified)u" % stats)
+         if (stats['uploaded'], stats['upload_skipped']) != (2, 1):
+            errors.append("API: expected 2 uploads and 1 skipped, got %(uploaded)u and %(upload_skipped)u" % stats)
+         if standin.requests.get('PUT myrules') != 2:
+            errors.append("API: server got %s uploads, expected 2" % standin.requests.get('PUT myrules'))
+         sources = sorted(rule['source'] for rule in standin.myrules['iptables'])
+         if '10.0.0.50' not in sources or '10.0.0.2' in sources:
+            errors.append("API: uploaded ruleset is stale: %s" % sources)
+         if sorted((n['action'], n['ip']) for n in standin.notes) != [('ban', '10.0.0.50'), ('unban', '10.0.0.2')]:
+            errors.append("API: unexpected notes %s" % standin.notes)
+         if not [msg for msg in logged if msg.startswith('API: ')]:
+            errors.append("API: counters weren't logged")
+         standin.set('bans', [])
+         run_new_checks()
+         if API.stats['fetched'] != 3:
+            errors.append("API: changed ban list wasn't fetched again")
+      finally:
+         standin.server.shutdown()
+         CONFIG, API, UPLOAD_FREQUENCY = saved
+
+      # No ip6tables: v6 changes can't be made, and we must say so
+      executables['ip6tables'] = os.path.join(statedir, 'no-such-ip6tables')
+      set_executables(executables)
+      fw.ban('2001:db8::3')
+      added, removed = fw.apply()
+      if added or fw.inlist('2001:db8::3'):
+         errors.append("IPv6 ban reported as applied without ip6tables")
+      if not [msg for msg in logged if 'IPv6' in msg]:
+         errors.append("dropped IPv6 ban wasn't logged")
+   finally:
+      syslog.syslog = SYSLOG
+      set_executables(original)
+      shutil.rmtree(statedir)
+   for error in errors:
+      print("FAIL: %s" % error)
+   print("FAIL" if errors else "OK")
+   return not errors
+
 def psyslog(a,b):
    """ nasty hack for copying syslog calls to stdout """
    SYSLOG(a, b)
@@ -445,36 +1027,46 @@ def base_parser():
     arg_parser.add_argument("-d", "--daemonize", action = 'store_true', help="Run blocky as a daemon")
     arg_parser.add_argument("-s", "--stop", action = 'store_true', help="Stop blocky daemon")
     arg_parser.add_argument("-f", "--foreground", action = 'store_true', help="Run blocky in the foreground (debugging)")
+    arg_parser.add_argument("--benchmark", action = 'store_true', help="Benchmark ban list lookups on synthetic data")
+    arg_parser.add_argument("--selftest", action = 'store_true', help="Test iptables handling against fake iptables binaries")
     return arg_parser
 
 
 def start_client():
    global CONFIG
+   args = base_parser().parse_args()
+   if args.benchmark:
+      benchmark()
+      return
+   if args.selftest:
+      sys.exit(0 if selftest() else 1)
+   
    # Figure out who we are
    me = socket.getfqdn()
    
    # Load YAML
    CONFIG = yaml.load(open('./blocky.yaml').read())
+   set_executables(CONFIG.get('iptables', {}))
    if 'client' not in CONFIG:
       CONFIG['client'] = {}
    if 'hostname' not in CONFIG['client']:
       CONFIG['client']['hostname'] = me
    
-   # Get current list of bans in iptables, upload it to blocky server
-   l = getbans()
-   
-   args = base_parser().parse_args()
+   # Get current list of bans in iptables
+   ychains = CONFIG.get('iptables', {}).get('chains')
+   fw = Firewall(ychains if ychains else ['INPUT'])
    
    # CLI unban?
    if args.unban:
       ip = args.unban
-      found = inlist(l, ip) # random test
+      found = fw.inlist(ip) # random test
       if found:
-         entry = found[0] # Only get the first entry, line numbers will then change ;\
-         print("Found a block for %s on line %s in the %s chain (as %s), removing..." % (ip, entry['linenumber'], entry['chain'], entry['source']))
-         if unban_line(entry['linenumber']):
-            print("Refreshing ban list...")
-            l = getbans()
+         for entry in found:
+            print("Found a block for %s on line %s in the %s chain (as %s), removing..." % (ip, entry['linenumber'], entry['chain'], entry['source']))
+            fw.unban(entry)
+         added, removed = fw.apply()
+         if len(removed) != len(found):
+            print("Could not remove all bans for %s, bummer" % ip)
       else:
          print("%s wasn't found in iptables, nothing to do" % ip)
       return
@@ -482,11 +1074,13 @@ def start_client():
    # CLI ban?
    if args.ban:
       ip = args.ban
-      found = inlist(l, ip)
+      found = fw.inlist(ip)
       if found:
          print("%s is already banned here as %s, nothing to do" % (ip, found[0]['source']))
       else:
-         if ban(ip):
+         fw.ban(ip)
+         added, removed = fw.apply()
+         if added:
             print("IP %s successfully banned using generic ruleset" % ip)
          else:
             print("Could not ban %s, bummer" % ip)
@@ -505,5 +1099,8 @@ def start_client():
       run_daemon(True)
 
 if __name__ == '__main__':
-   start_client()
+   if sys.argv[1:2] == ['--fake-iptables']:
+      fake_iptables(sys.argv[2:])
+   else:
+      start_client()
 
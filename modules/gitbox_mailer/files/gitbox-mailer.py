@@ -29,6 +29,7 @@ import re
 import copy
 import sys
 import requests
+import heapq
 
 # Defaults and settings
 PUBSUB_URL = 'http://pubsub.apache.org:2069/github'  # Subscribe to github events only
@@ -50,6 +51,7 @@ EMAIL_SUBJECTS = {
 JIRA_DEFAULT_OPTIONS = 'link label'
 JIRA_CREDENTIALS = '/x1/jirauser.txt'
 LAST_CALL = int(time.time())
+QUIET_PERIOD = 5 # Seconds an event must go without new review comments before we send it
 
 # Globals we figure out as we go along..
 DEBUG = bool(sys.argv[1:]) # thus 'python3 gitbox-mailer.py debug' to set debug mode
@@ -61,7 +63,11 @@ JIRA_HEADERS = {
 RE_PROJECT = re.compile(r"(?:incubator-)?([^-]+)")
 RE_JIRA_TICKET = re.compile(r"\b([A-Z0-9]+-\d+)\b")
 
-TLOCK = threading.Lock()
+# Guards PUBSUB_QUEUE and DEADLINES, and wakes the Actor up when an earlier deadline comes in.
+# DEADLINES is a heap of (time to send, key). When an event gets more comments, its new
+# deadline is pushed on top and the old entry is skipped once it comes up.
+TLOCK = threading.Condition()
+DEADLINES = []
 
 ####################################################
 def jira_update_ticket(ticket, txt, worklog=False):
@@ -209,6 +215,7 @@ class Event:
         self.subject = None
         self.message = None
         self.updated = time.time()
+        self.deadline = self.updated + QUIET_PERIOD
         self.payload['reviews'] = None
 
         if data.get('filename'):
@@ -220,6 +227,7 @@ class Event:
             self.payload['reviews'] = []
         self.payload['reviews'].append(Helper(data))
         self.updated = time.time()
+        self.deadline = self.updated + QUIET_PERIOD
 
     def format_message(self, template = DEFAULT_TEMPLATE):
         self.payload['action_text'] = EMAIL_SUBJECTS.get(self.action, EMAIL_SUBJECTS['comment']) % self.payload
@@ -306,25 +314,31 @@ class Actor(threading.Thread):
     def __init__(self):
         threading.Thread.__init__(self)
 
+    def next_event(self):
+        """ Waits for the earliest deadline to pass, then takes that event off the queue """
+        with TLOCK:
+            while True:
+                # Throw away heap entries for deadlines that have since been extended
+                while DEADLINES:
+                    deadline, key = DEADLINES[0]
+                    event_object = PUBSUB_QUEUE.get(key)
+                    if event_object and event_object.deadline == deadline:
+                        break
+                    heapq.heappop(DEADLINES)
+                now = time.time()
+                if DEADLINES and DEADLINES[0][0] <= now:
+                    deadline, key = heapq.heappop(DEADLINES)
+                    return PUBSUB_QUEUE.pop(key)
+                TLOCK.wait(DEADLINES[0][0] - now if DEADLINES else None)
+
     def run(self):
-        """ Copy queue, clear it and run each item """
+        """ Send each event as soon as its quiet period is over """
         while True:
-            QUEUE_COPY = {}
-            with TLOCK:
-                QUEUE_COPY = PUBSUB_QUEUE.copy()
-            for key, event_object in QUEUE_COPY.items():
-                now = time.time()
-                if now - event_object.updated > 5:
-                    try:
-                        with TLOCK:
-                            del PUBSUB_QUEUE[key]
-                    except:
-                        print("[ERROR] Could not prune pubsub queue - double free?")
-                    try:
-                        event_object.process()
-                    except Exception as e:
-                        print("[WARNING] Could not process payload: %s" % e)
-            time.sleep(10)
+            event_object = self.next_event()
+            try:
+                event_object.process()
+            except Exception as e:
+                print("[WARNING] Could not process payload: %s" % e)
 
 
 def process(js):
@@ -344,6 +358,11 @@ def process(js):
             PUBSUB_QUEUE[key] = Event(key, js)
         else:
             PUBSUB_QUEUE[key].add(js)
+        entry = (PUBSUB_QUEUE[key].deadline, key)
+        heapq.heappush(DEADLINES, entry)
+        # Only a new earliest deadline changes how long the Actor should sleep
+        if DEADLINES[0] == entry:
+            TLOCK.notify()
 
 if __name__ == '__main__':
     if DEBUG:
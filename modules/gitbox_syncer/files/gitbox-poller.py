@@ -29,8 +29,183 @@ import asfpy.messaging
 import contextlib
 import yaml
 import requests
+import threading
+import collections
+import signal
+import random
+import shutil
+import tempfile
 
-SEEN = []
+class Database(object):
+    """ One long-lived connection to gitbox.db, shared by all workers.
+    The database is put in WAL mode, so we and the pre-receive hooks can
+    read while the other writes. GitHub -> ASF id lookups are cached for
+    ids_ttl seconds, and pushlog rows are written in batches, at most
+    flush_interval seconds apart. """
+    def __init__(self, path, ids_ttl = 300, flush_size = 50, flush_interval = 2):
+        self.path = path
+        self.ids_ttl = ids_ttl
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(path, timeout = 15, check_same_thread = False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.ids = {}           # lowercased githubid -> (asfid or None, time looked up)
+        self.pushes = []        # pushlog rows not yet written
+        self.last_flush = time.time()
+        self.failing = False
+
+    def execute(self, sql, args = (), commit = False):
+        with self.lock:
+            rows = self.conn.execute(sql, args).fetchall()
+            if commit:
+                self.conn.commit()
+            return rows
+
+    def asfid(self, githubid):
+        """ Returns the ASF id for a GitHub id, or None if we don't know them """
+        key = githubid.lower()
+        now = time.time()
+        with self.lock:
+            cached = self.ids.get(key)
+            if cached and now - cached[1] < self.ids_ttl:
+                return cached[0]
+            row = self.conn.execute("SELECT asfid FROM ids WHERE githubid=? COLLATE NOCASE", (githubid, )).fetchone()
+            self.ids[key] = (row[0] if row else None, now)
+            return self.ids[key][0]
+
+    def invalidate(self, githubid = None):
+        """ Forgets a cached id (or all of them), for when MATT changes them """
+        with self.lock:
+            if githubid:
+                self.ids.pop(githubid.lower(), None)
+            else:
+                self.ids.clear()
+
+    def have_push(self, reponame, new):
+        """ Returns True if we've logged a push resulting in `new`, None if
+        we've never logged a push for this repo at all, False otherwise """
+        with self.lock:
+            for push in self.pushes:
+                if push[6] == new:
+                    return True
+            if self.conn.execute("SELECT id FROM pushlog WHERE new=?", (new, )).fetchone():
+                return True
+            for push in self.pushes:
+                if push[0] == reponame:
+                    return False
+            if self.conn.execute("SELECT id FROM pushlog WHERE repository=?", (reponame, )).fetchone():
+                return False
+            return None
+
+    def log_push(self, reponame, asfid, pusher, baseref, ref, before, after):
+        with self.lock:
+            self.pushes.append((reponame, asfid, pusher, baseref, ref, before, after,
+                                time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())))
+            if len(self.pushes) >= self.flush_size:
+                self.flush()
+
+    def flush(self, force = False):
+        """ Writes out pending pushlog rows, if there are enough of them
+        or they've waited long enough. If sqlite borks, let infra know
+        (once) and hang on to the rows for the next try. """
+        with self.lock:
+            if not self.pushes:
+                return
+            if not force and len(self.pushes) < self.flush_size and time.time() - self.last_flush < self.flush_interval:
+                return
+            try:
+                self.conn.executemany("""INSERT INTO pushlog
+                          (repository, asfid, githubid, baseref, ref, old, new, date)
+                          VALUES (?,?,?,?,?,?,?,?)""", self.pushes)
+                self.conn.commit()
+                self.pushes = []
+                self.failing = False
+            except sqlite3.Error as e:
+                self.conn.rollback()
+                if not self.failing:
+                    self.failing = True
+                    asfpy.messaging.mail(
+                            recipient = '<notifications@infra.apache.org>',
+                            subject = "gitbox poller: sqlite operational error!",
+                            sender = '<gitbox@apache.org>',
+                            message = "gitbox.db could not be written to: %s\n%u push log entries are pending." % (e.args[0], len(self.pushes)),
+                            )
+            self.last_flush = time.time()
+
+# Our connection to gitbox.db, set up by main()
+DB = None
+
+
+class SeenCache(object):
+    """ Remembers which pushes we've already synced, so we can drop the
+    duplicate webhooks GitHub sometimes sends. Holds at most `size`
+    entries for at most `ttl` seconds, least recently seen goes first.
+    If given a Database, entries are also kept in a 'seen' table there,
+    so we still know about them after a restart. Pushes are only added
+    once they have been synced, so a payload that failed half way (and
+    is redelivered) is not mistaken for a duplicate. """
+    def __init__(self, size = 10000, ttl = 86400, database = None):
+        self.size = size
+        self.ttl = ttl
+        self.database = database
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict() # hash -> time last seen
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        if database:
+            self.load()
+
+    def load(self):
+        try:
+            self.database.execute("CREATE TABLE IF NOT EXISTS seen (hash TEXT PRIMARY KEY, seen REAL)")
+            self.database.execute("DELETE FROM seen WHERE seen < ?", (time.time() - self.ttl, ), commit = True)
+            rows = self.database.execute("SELECT hash, seen FROM seen ORDER BY seen DESC LIMIT ?", (self.size, ))
+            for key, when in reversed(rows):
+                self.entries[key] = when
+        except sqlite3.Error as e:
+            print("Could not load seen pushes from %s: %s" % (self.database.path, e))
+            self.database = None
+
+    def store(self, key, now):
+        try:
+            self.database.execute("INSERT OR REPLACE INTO seen (hash, seen) VALUES (?, ?)", (key, now), commit = True)
+            self.stored += 1
+            # Prune the table every now and then, it only needs what we hold in memory
+            if self.stored % 1000 == 0:
+                self.database.execute("DELETE FROM seen WHERE seen < ?", (now - self.ttl, ), commit = True)
+        except sqlite3.Error as e:
+            print("Could not store seen push %s: %s" % (key, e))
+
+    def seen(self, key):
+        """ Returns True if key was added within the TTL """
+        now = time.time()
+        with self.lock:
+            when = self.entries.get(key)
+            if when is not None and now - when < self.ttl:
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def add(self, key):
+        """ Remembers a push we're done with """
+        now = time.time()
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = now
+            while len(self.entries) > self.size:
+                self.entries.popitem(last = False)
+        if self.database:
+            self.store(key, now)
+
+    def report(self):
+        return "Dedup cache: %u entries, %u duplicates dropped, %u new pushes" % (len(self.entries), self.hits, self.misses)
+
+# Pushes we've seen recently; main() swaps in one configured from gitbox-poller.yaml
+SEEN = SeenCache()
 
 # These are CI accounts that do not have ICLAs, one per line please
 OUR_BOTS = (
@@ -38,8 +213,13 @@ OUR_BOTS = (
 )
 
 # GitHub -> GitBox code sync    
-def parse_payload(config, data):
+# This runs on worker threads, so it must not change the working directory;
+# subprocesses get a cwd instead. Time spent fetching and running hooks is
+# recorded in timings, if given.
+def parse_payload(config, data, timings = None):
     repo_dirs = config['paths']
+    if timings is None:
+        timings = {}
     
     tmpl_missed_webhook = """
     The repository %(reponame)s seems to have missed a webhook call.
@@ -83,27 +263,19 @@ def parse_payload(config, data):
         wikipath = os.path.join(config['wikipath'], "%s.wiki.git" % repo)
         wikiurl = "https://github.com/apache/%s.wiki.git" % repo
         # If we don't have the wiki.git yet, clone it
+        start = time.time()
         if not os.path.exists(wikipath):
-            os.chdir(config['wikipath'])
-            subprocess.check_output(['git','clone', '--mirror', wikiurl, wikipath])
+            subprocess.check_output(['git','clone', '--mirror', wikiurl, wikipath], cwd=config['wikipath'])
     
-        # chdir to wiki git, pull in changes
-        os.chdir(wikipath)
-        subprocess.check_output(['git','fetch'])
+        # pull in changes to the wiki git
+        subprocess.check_output(['git','fetch'], cwd=wikipath)
+        timings['fetch'] = time.time() - start
     
         ########################
         # Get ASF ID of pusher #
         ########################
-        asfid = "unknown"
         pusher = data['sender']['login']
-        conn = sqlite3.connect(config['database'])
-        cursor = conn.cursor()
-        cursor.execute("SELECT asfid FROM ids WHERE githubid=? COLLATE NOCASE", (pusher, ))
-        row = cursor.fetchone()
-        # Found it, yay!
-        if row:
-            asfid = row[0]
-        conn.close()
+        asfid = DB.asfid(pusher) or "unknown"
     
         # Ready the hook env
         gitenv = {
@@ -120,16 +292,17 @@ def parse_payload(config, data):
             'WRITE_LOCK': '/x1/gitbox/write.lock',
             'AUTH_FILE': '/x1/gitbox/conf/auth.cfg'
         }
+        start = time.time()
         for page in data['pages']:
             after = page['sha']
-            before = subprocess.check_output(["git", "rev-list", "--parents", "-n", "1", after]).strip().split(' ')[1]
+            before = subprocess.check_output(["git", "rev-list", "--parents", "-n", "1", after], cwd=wikipath).strip().split(' ')[1]
             update = "%s %s refs/heads/master\n" % (before if before != after else EMPTY_HASH, after)
     
             # Fire off the multimail hook for the wiki
             try:
                 hook = "/x1/gitbox/hooks/post-receive"
                 # Fire off the email hook
-                process = subprocess.Popen([hook], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=gitenv)
+                process = subprocess.Popen([hook], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=gitenv, cwd=wikipath)
                 out, err = process.communicate(input=update)
                 log += out
                 log += "[%s] [%s]: Multimail deployed (%s -> %s)!\n" % (time.strftime("%c"), wikipath, before, after)
@@ -137,6 +310,7 @@ def parse_payload(config, data):
             except Exception as err:
                 log += "[%s] [%s]: Multimail hook failed: %s\n" % (time.strftime("%c"), wikipath, err)
             open(config['logfile'], "a").write(log)
+        timings['hook'] = time.time() - start
     
     
     
@@ -149,12 +323,12 @@ def parse_payload(config, data):
         after = data.get('after', EMPTY_HASH)
         
         # GitHub may send duplicate webhooks for the same push (for reasons unknown!), so dedup here.
+        # The push is only marked as seen at the very end, once it's been dealt with.
+        seen_hash = None
         if reponame and ref and before and after:
             seen_hash = "%s-%s-%s-%s" % (reponame, ref, before, after)  # kibble-newbranch-0000000000000000-fa676777662783462 or such
-            if seen_hash in SEEN:
+            if SEEN.seen(seen_hash):
                 return
-            else:
-                SEEN.append(seen_hash)
         
         force_diff = False
         merge_from_fork = False
@@ -189,16 +363,9 @@ def parse_payload(config, data):
         if pusher != 'asfgit' and repopath and os.path.exists(repopath):
 
             # Figure out who pushed:
-            with contextlib.closing(sqlite3.connect(config['database'])) as conn:
-                cursor = conn.cursor()
-                cursor.execute("SELECT asfid FROM ids WHERE githubid=? COLLATE NOCASE", (pusher, ))
-                row = cursor.fetchone()
-
-
-            if row:
-                asfid = row[0]                
+            asfid = DB.asfid(pusher)
             # Didn't find it, time to notify!!
-            else:
+            if not asfid:
                 asfid = "(unknown)"
                 if '[bot]' not in pusher and pusher not in OUR_BOTS: # If not internal GitHub bot, complain!
                     # Send an email to users@infra.a.o with the bork
@@ -221,21 +388,12 @@ def parse_payload(config, data):
             #######################################
             if before and before != EMPTY_HASH:
                 try:
-                    with contextlib.closing(sqlite3.connect(config['database'])) as conn:
-                        cursor = conn.cursor()
-                        # First, check the db for pushes we have
-                        cursor.execute("SELECT id FROM pushlog WHERE new=?", (before, ))
-                        foundOld = cursor.fetchone()
-                        if not foundOld:
-                            # See if we've ever gotten any push logs for this repo, or if this is a first
-                            tcursor = conn.cursor() # make a temp cursor, try fetching one row
-                            tcursor.execute("SELECT id FROM pushlog WHERE repository=?", (reponame, ))
-                            foundAny = tcursor.fetchone()
-                            if foundAny:
-                                raise Exception("Could not find previous push (??->%s) in push log!" % before)
-                    # Then, be doubly sure by doing cat-file on the old rev (AFTER sqlite is closed)
-                    os.chdir(repopath)
-                    subprocess.check_call(['git','cat-file','-e', before])
+                    # First, check the db for pushes we have. If we've never gotten any
+                    # push logs for this repo, this is a first and that's fine.
+                    if DB.have_push(reponame, before) is False:
+                        raise Exception("Could not find previous push (??->%s) in push log!" % before)
+                    # Then, be doubly sure by doing cat-file on the old rev
+                    subprocess.check_call(['git','cat-file','-e', before], cwd=repopath)
                 except Exception as errmsg:
                     # Send an email to users@infra.a.o with the bork
                     asfpy.messaging.mail(
@@ -252,22 +410,8 @@ def parse_payload(config, data):
             ##################################
             # Write Push log, text + sqlite3 #
             ##################################
-            try:
-                with contextlib.closing(sqlite3.connect(config['database'], timeout = 15)) as conn:
-                    cursor = conn.cursor()
-                    cursor.execute("""INSERT INTO pushlog
-                              (repository, asfid, githubid, baseref, ref, old, new, date)
-                              VALUES (?,?,?,?,?,?,?,DATETIME('now'))""", (reponame, asfid, pusher, baseref, ref, before, after, ))
-                    conn.commit()
-            # If sqlite borks, let infra know...but keep syncing
-            except sqlite3.Error as e:
-                txt = e.args[0]
-                asfpy.messaging.mail(
-                        recipient = '<notifications@infra.apache.org>',
-                        subject = "gitbox repository %s: sqlite operational error!" % reponame,
-                        sender = '<gitbox@apache.org>',
-                        message = "gitbox.db could not be written to: %s" % txt,
-                        )
+            # The sqlite rows go out in batches, see Database.flush
+            DB.log_push(reponame, asfid, pusher, baseref, ref, before, after)
             
             open(os.path.join(config['pushlogs'], "%s.txt" % reponame), "a").write(
                 "[%s] %s -> %s (%s@apache.org / %s)\n" % (
@@ -286,9 +430,8 @@ def parse_payload(config, data):
             ####################
             log = "[%s] [%s.git]: Got a sync call for %s.git, pushed by %s\n" % (time.strftime("%c"), reponame, reponame, asfid)
     
-            # Change to repo dir
-            os.chdir(repopath)
             # Run 'git fetch --prune' (fetch changes, prune away branches no longer present in remote)
+            start = time.time()
             rv = True
             i = 0
             # Try fetching 5 times, 2 secs in between.
@@ -297,11 +440,13 @@ def parse_payload(config, data):
                 i += 1
                 p = subprocess.Popen(["git", "fetch", "--prune"],
                     stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE)
+                    stderr=subprocess.PIPE,
+                    cwd=repopath)
                 output,error = p.communicate()
                 rv = p.poll()
                 if rv:
                     time.sleep(2)
+            timings['fetch'] = time.time() - start
             if not rv:
                 log += "[%s] [%s.git]: Git fetch succeeded\n" % (time.strftime("%c"), reponame)
                 try:
@@ -354,44 +499,540 @@ def parse_payload(config, data):
                     }
                     update = "%s %s %s\n" % (before if before != after else EMPTY_HASH, after, ref)
     
+                    start = time.time()
                     try:
-                        # Change to repo dir
-                        os.chdir(repopath)
-    
-                        # Fire off the email hook
-                        process = subprocess.Popen([hook], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=gitenv)
+                        # Fire off the email hook, from the repo dir
+                        process = subprocess.Popen([hook], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=gitenv, cwd=repopath)
                         process.communicate(input=update)
                         log += "[%s] [%s.git]: Multimail deployed!\n" % (time.strftime("%c"), reponame)
     
                     except Exception as err:
                         log += "[%s] [%s.git]: Multimail hook failed: %s\n" % (time.strftime("%c"), reponame, err)
+                    timings['hook'] = time.time() - start
                 open(config['logfile'], "a").write(log)
     
+        if seen_hash:
+            SEEN.add(seen_hash)
+
+class RepoMetrics(object):
+    """ Per-repository latency: time payloads spent waiting in our queue,
+    in git fetch and in the multimail hook. """
+    PHASES = ('wait', 'fetch', 'hook')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.repos = {}
+
+    def record(self, repo, timings):
+        with self.lock:
+            stats = self.repos.setdefault(repo, dict([('payloads', 0)] + [(p, [0.0, 0.0]) for p in self.PHASES]))
+            stats['payloads'] += 1
+            for phase in self.PHASES:
+                spent = timings.get(phase, 0)
+                stats[phase][0] += spent
+                stats[phase][1] = max(stats[phase][1], spent)
+
+    def report(self, top = 10):
+        """ The repos we've spent the most time on, with total/max per phase """
+        with self.lock:
+            repos = sorted(self.repos.items(), key = lambda x: sum(x[1][p][0] for p in self.PHASES), reverse = True)
+            lines = ["Per-repo latency (total/max seconds), %u repos seen:" % len(self.repos)]
+            for repo, stats in repos[:top]:
+                lines.append("  %-40s %4u payloads  " % (repo, stats['payloads']) + "  ".join(
+                    "%s %.1f/%.1f" % (p, stats[p][0], stats[p][1]) for p in self.PHASES))
+        return "\n".join(lines)
+
+
+class QueueClient(object):
+    """ Talks to the SQS bridge over keep-alive sessions. Receives are
+    long-polled (the bridge may hold the request for up to `wait` seconds
+    until something arrives); if it answers right away with nothing, we
+    back off from min_interval to max_interval between polls instead, and
+    poll again immediately whenever we got payloads. Payloads we receive
+    stay invisible to other pollers for `visibility` seconds, so if we
+    never acknowledge one (because processing failed) it comes back after
+    that. Acknowledgements are queued and sent in batches, as a single
+    request if the bridge takes several ids at once (batch_ack). """
+    def __init__(self, api, wait = 20, visibility = 300, batch_ack = False, ack_batch = 10,
+                 ack_interval = 1, min_interval = 0.5, max_interval = 5):
+        self.get_url = "%s/get" % api
+        self.delete_url = "%s/delete" % api
+        self.wait = wait
+        self.visibility = visibility
+        self.batch_ack = batch_ack
+        self.ack_batch = ack_batch
+        self.ack_interval = ack_interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.delay = 0
+        self.session = requests.Session()       # receives, main thread only
+        self.ack_session = requests.Session()   # acks, under ack_lock
+        self.ack_lock = threading.RLock()
+        self.acks = []
+        self.last_ack = time.time()
+        self.stats = collections.Counter()
+
+    def receive(self):
+        """ Waits for and returns the next lot of payloads, possibly none """
+        if self.delay:
+            time.sleep(self.delay)
+        start = time.time()
+        try:
+            self.stats['polls'] += 1
+            rv = self.session.get(self.get_url, params = {'wait': self.wait, 'visibility': self.visibility},
+                                  timeout = (10, self.wait + 10))
+            payloads = rv.json()['payloads']
+        except Exception as e:
+            print("Could not fetch payloads from queue: %s" % e)
+            self.stats['errors'] += 1
+            self.delay = self.max_interval
+            return []
+        self.stats['received'] += len(payloads)
+        if payloads or time.time() - start >= self.wait / 2.0:
+            # Got something, or the bridge long-polled for us; ask again right away
+            self.delay = 0
+        else:
+            self.stats['empty'] += 1
+            self.delay = min(max(self.delay * 2, self.min_interval), self.max_interval)
+        return payloads
+
+    def ack(self, pid):
+        """ Marks a payload as done, so it's deleted from the queue """
+        with self.ack_lock:
+            self.acks.append(pid)
+            if len(self.acks) >= self.ack_batch:
+                self.flush_acks()
+
+    def flush(self):
+        """ Sends off queued acks that have waited long enough """
+        with self.ack_lock:
+            if self.acks and time.time() - self.last_ack >= self.ack_interval:
+                self.flush_acks()
+
+    def flush_acks(self):
+        # Call with ack_lock held. Anything that fails is tried again next time,
+        # if it doesn't make it before the visibility timeout we'll just see it
+        # again and the dedup cache drops it.
+        if self.batch_ack:
+            batches = [self.acks[i:i + self.ack_batch] for i in range(0, len(self.acks), self.ack_batch)]
+        else:
+            batches = [[pid] for pid in self.acks]
+        failed = []
+        for batch in batches:
+            try:
+                self.stats['ack_requests'] += 1
+                rv = self.ack_session.get(self.delete_url, params = [('id', pid) for pid in batch], timeout = 30)
+                rv.raise_for_status()
+                self.stats['acked'] += len(batch)
+                print("Removed %s from queue" % ", ".join(pid[:31] for pid in batch))
+            except Exception as e:
+                print("Could not remove %u payload(s) from queue: %s" % (len(batch), e))
+                self.stats['errors'] += 1
+                failed.extend(batch)
+        self.acks = failed
+        self.last_ack = time.time()
+
+    def report(self):
+        return "Queue: %(polls)u polls (%(empty)u empty), %(received)u payloads received, %(acked)u acknowledged in %(ack_requests)u requests, %(errors)u errors" % self.stats
+
+
+class RepoPool(object):
+    """ Processes payloads on a pool of worker threads. Payloads for the
+    same repository are handled one at a time, in the order they arrived,
+    so pushes are synced in order; different repositories run in parallel,
+    so one slow or broken repo doesn't hold up everybody else. A payload
+    that fails goes back to the front of its repo's queue and the repo is
+    parked for retry_delay seconds, doubling on every failure up to
+    max_retry_delay, so nothing after it is synced before it. At most
+    max_pending payloads are held at a time (see wait_for_room), so a slow
+    spell doesn't pile up payloads here until their visibility runs out. """
+    def __init__(self, config, workers, queue, handler = None, max_pending = None,
+                 retry_delay = 5, max_retry_delay = 300):
+        self.config = config
+        self.queue = queue
+        self.handler = handler or parse_payload
+        self.max_pending = max_pending or workers * 10
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.cond = threading.Condition()
+        self.pending = {}                # repo -> deque of (payload, time queued)
+        self.ready = collections.deque() # repos with pending payloads that no worker has
+        self.active = set()              # repos a worker is on right now
+        self.parked = {}                 # repo -> when to retry its failed payload
+        self.failures = {}               # payload id -> failed attempts so far
+        self.inflight = set()            # payload ids queued or being processed
+        self.metrics = RepoMetrics()
+        for i in range(workers):
+            worker = threading.Thread(target = self.work)
+            worker.daemon = True
+            worker.start()
+
+    def submit(self, payload):
+        """ Queues a payload, unless we already have it (SQS hands out
+        payloads again if we don't delete them within the visibility timeout) """
+        data = payload.get('payload') or {}
+        repo = (data.get('repository') or {}).get('name', '')
+        if 'pages' in data:
+            repo += '.wiki'
+        with self.cond:
+            if payload['id'] in self.inflight:
+                return False
+            self.inflight.add(payload['id'])
+            self.pending.setdefault(repo, collections.deque()).append((payload, time.time()))
+            if repo not in self.active and repo not in self.parked and repo not in self.ready:
+                self.ready.append(repo)
+                self.cond.notify()
+        return True
+
+    def work(self):
+        while True:
+            with self.cond:
+                while True:
+                    timeout = self.unpark()
+                    if self.ready:
+                        break
+                    self.cond.wait(timeout)
+                repo = self.ready.popleft()
+                self.active.add(repo)
+                payload, queued = self.pending[repo].popleft()
+            ok = False
+            try:
+                ok = self.process(repo, payload, queued)
+            finally:
+                with self.cond:
+                    self.active.discard(repo)
+                    if ok:
+                        self.inflight.discard(payload['id'])
+                        self.failures.pop(payload['id'], None)
+                    else:
+                        # Keep holding it (so a redelivered copy is ignored) and retry it first
+                        tries = self.failures[payload['id']] = self.failures.get(payload['id'], 0) + 1
+                        self.pending[repo].appendleft((payload, queued))
+                        self.parked[repo] = time.time() + min(self.retry_delay * 2 ** (tries - 1), self.max_retry_delay)
+                    if repo not in self.parked:
+                        if self.pending[repo]:
+                            self.ready.append(repo)
+                        else:
+                            del self.pending[repo]
+                    # Wakes a worker for the repo, and wait_for_room
+                    self.cond.notify_all()
+
+    def unpark(self):
+        """ Makes parked repos that are due for a retry ready again. Call with
+        cond held; returns how long until the next one is due, if any. """
+        now = time.time()
+        for repo, when in list(self.parked.items()):
+            if when <= now:
+                del self.parked[repo]
+                self.ready.append(repo)
+        if self.parked:
+            return max(min(self.parked.values()) - now, 0.01)
+        return None
+
+    def wait_for_room(self):
+        """ Blocks until we hold fewer than max_pending payloads. Call before
+        receiving more; a receive can take us up to one batch over. """
+        with self.cond:
+            while len(self.inflight) >= self.max_pending:
+                self.cond.wait(1)
+
+    def process(self, repo, payload, queued):
+        timings = {'wait': time.time() - queued}
+        try:
+            self.handler(self.config, payload['payload'], timings)
+            print("Processed %s, removing from queue..." % payload['id'][:31])
+            self.queue.ack(payload['id'])
+            ok = True
+        except Exception as e:
+            print("Payload %s failed to process, retrying it before the rest of %s: %s" % (payload['id'][:31], repo, e))
+            ok = False
+        self.metrics.record(repo, timings)
+        return ok
+
+
+def benchmark(count = 1000):
+    """ Runs the database side of `count` synthetic push payloads against
+    a scratch sqlite file, once the old way (a fresh connection for every
+    query, a commit per push) and once through Database. """
+    tmpdir = tempfile.mkdtemp()
+    try:
+        users = ["ghuser%u" % i for i in range(500)]
+        repos = ["repo%u" % i for i in range(200)]
+        heads = dict((repo, '%040x' % random.getrandbits(160)) for repo in repos)
+        template = os.path.join(tmpdir, 'template.db')
+        with contextlib.closing(sqlite3.connect(template)) as conn:
+            conn.execute("CREATE TABLE ids (githubid TEXT, asfid TEXT)")
+            conn.execute("""CREATE TABLE pushlog (id INTEGER PRIMARY KEY, repository TEXT, asfid TEXT,
+                            githubid TEXT, baseref TEXT, ref TEXT, old TEXT, new TEXT, date TEXT)""")
+            conn.executemany("INSERT INTO ids VALUES (?, ?)", [(u, u.replace('ghuser', 'asf')) for u in users])
+            conn.executemany("INSERT INTO pushlog (repository, asfid, githubid, baseref, ref, old, new, date) VALUES (?,?,?,?,?,?,?,DATETIME('now'))",
+                             [(repo, 'asf0', 'ghuser0', 'refs/heads/master', 'refs/heads/master', '0'*40, heads[repo]) for repo in repos])
+            conn.commit()
+        payloads = []
+        for i in range(count):
+            repo = random.choice(repos)
+            after = '%040x' % random.getrandbits(160)
+            payloads.append((repo, random.choice(users), heads[repo], after))
+            heads[repo] = after
+
+        def legacy(path):
+            missed = 0
+            for repo, pusher, before, after in payloads:
+                with contextlib.closing(sqlite3.connect(path)) as conn:
+                    row = conn.execute("SELECT asfid FROM ids WHERE githubid=? COLLATE NOCASE", (pusher, )).fetchone()
+                with contextlib.closing(sqlite3.connect(path)) as conn:
+                    if not conn.execute("SELECT id FROM pushlog WHERE new=?", (before, )).fetchone():
+                        if conn.execute("SELECT id FROM pushlog WHERE repository=?", (repo, )).fetchone():
+                            missed += 1
+                with contextlib.closing(sqlite3.connect(path, timeout = 15)) as conn:
+                    conn.execute("""INSERT INTO pushlog (repository, asfid, githubid, baseref, ref, old, new, date)
+                                    VALUES (?,?,?,?,?,?,?,DATETIME('now'))""", (repo, row[0], pusher, 'refs/heads/master', 'refs/heads/master', before, after))
+                    conn.commit()
+            return missed
+
+        def pooled(path):
+            missed = 0
+            db = Database(path)
+            for repo, pusher, before, after in payloads:
+                asfid = db.asfid(pusher)
+                if db.have_push(repo, before) is False:
+                    missed += 1
+                db.log_push(repo, asfid, pusher, 'refs/heads/master', 'refs/heads/master', before, after)
+                db.flush()
+            db.flush(force = True)
+            return missed
+
+        for name, run in (('connection per query', legacy), ('Database', pooled)):
+            path = os.path.join(tmpdir, "%s.db" % run.__name__)
+            shutil.copy(template, path)
+            start = time.time()
+            missed = run(path)
+            took = time.time() - start
+            with contextlib.closing(sqlite3.connect(path)) as conn:
+                logged = conn.execute("SELECT COUNT(*) FROM pushlog").fetchone()[0] - len(repos)
+            print("%-22s %u payloads in %.3fs (%.2f ms/payload), %u logged, %u missed pushes" % (
+                name, count, took, took * 1000 / count, logged, missed))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def flusher(queue, database, interval):
+    """ Sends off acks and pushlog rows every `interval` seconds, so they
+    don't have to wait for the main loop's long-poll to come back """
+    while True:
+        time.sleep(interval)
+        try:
+            queue.flush()
+            if database:
+                database.flush()
+        except Exception as e:
+            print("Could not flush acks/push log: %s" % e)
+
+def start_flusher(queue, database, interval):
+    thread = threading.Thread(target = flusher, args = (queue, database, interval))
+    thread.daemon = True
+    thread.start()
+
+
+class StandinQueue(object):
+    """ A local stand-in for the SQS bridge, for --selftest: get hands out
+    up to 10 visible payloads (long-polling for up to ?wait= seconds) and
+    hides them for ?visibility= seconds, delete takes one or more ?id=. """
+    def __init__(self):
+        try:
+            from http.server import HTTPServer, BaseHTTPRequestHandler
+            from socketserver import ThreadingMixIn
+            from urllib.parse import urlparse, parse_qs
+        except ImportError:
+            from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+            from SocketServer import ThreadingMixIn
+            from urlparse import urlparse, parse_qs
+        self.cond = threading.Condition()
+        self.messages = {}      # id -> [payload, visible again at]
+        self.requests = collections.Counter()
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            def log_message(self, *args):
+                pass
+            def do_GET(self):
+                url = urlparse(self.path)
+                args = parse_qs(url.query)
+                if url.path.endswith('/get'):
+                    body = json.dumps({'payloads': standin.get(float(args.get('wait', [0])[0]), float(args.get('visibility', [30])[0]))})
+                else:
+                    body = standin.delete(args.get('id', []))
+                body = body.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.api = "http://127.0.0.1:%u/default" % self.server.server_address[1]
+        thread = threading.Thread(target = self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def put(self, pid, payload):
+        with self.cond:
+            self.messages[pid] = [payload, 0]
+            self.cond.notify_all()
+
+    def get(self, wait, visibility):
+        deadline = time.time() + wait
+        with self.cond:
+            self.requests['get'] += 1
+            while True:
+                now = time.time()
+                ready = [pid for pid in sorted(self.messages) if self.messages[pid][1] <= now][:10]
+                if ready or now >= deadline:
+                    break
+                self.cond.wait(min(deadline - now, 0.1))
+            for pid in ready:
+                self.messages[pid][1] = now + visibility
+            return [{'id': pid, 'payload': self.messages[pid][0]} for pid in ready]
+
+    def delete(self, pids):
+        with self.cond:
+            self.requests['delete'] += 1
+            for pid in pids:
+                self.messages.pop(pid, None)
+        return "Deleted %u" % len(pids)
+
+    def __len__(self):
+        with self.cond:
+            return len(self.messages)
+
+
+def selftest(count = 40, repos = 5):
+    """ Runs QueueClient and RepoPool against a StandinQueue. Every 7th
+    payload fails the first time round and must be retried before anything
+    after it for the same repo. Checks that everything is processed, in
+    order per repo, that acks are batched and don't wait for the long-poll, and
+    that we stop polling while the pool is full. """
+    standin = StandinQueue()
+    # Acks only go out on ack_interval here, never because a batch filled up
+    queue = QueueClient(standin.api, wait = 5, visibility = 1, batch_ack = True, ack_batch = count * 2, ack_interval = 0.2)
+    lock = threading.Lock()
+    done = []
+    held = []
+    failed = set()
+    def handler(config, data, timings):
+        if data['n'] % 7 == 3 and data['n'] not in failed:
+            failed.add(data['n'])
+            raise Exception("failing %u once" % data['n'])
+        with lock:
+            done.append((data['repository']['name'], data['n']))
+    pool = RepoPool({}, 4, queue, handler, max_pending = 8, retry_delay = 0.1)
+    start_flusher(queue, None, 0.2)
+    def poll():
+        while True:
+            pool.wait_for_room()
+            with lock:
+                held.append(len(pool.inflight))
+            for payload in queue.receive():
+                pool.submit(payload)
+    thread = threading.Thread(target = poll)
+    thread.daemon = True
+    thread.start()
+
+    start = time.time()
+    for n in range(count):
+        standin.put("msg%05u" % n, {'repository': {'name': "repo%u" % (n % repos)}, 'n': n})
+    while len(standin) and time.time() - start < 30:
+        time.sleep(0.05)
+    took = time.time() - start
+    # One more on a quiet queue: its ack must not sit there until the long-poll returns
+    lone = time.time()
+    standin.put("msg%05u" % count, {'repository': {'name': "repo0"}, 'n': count})
+    while len(standin) and time.time() - lone < 10:
+        time.sleep(0.05)
+    lone = time.time() - lone
+
+    errors = []
+    if len(standin):
+        errors.append("%u payloads never acknowledged" % len(standin))
+    if sorted(set(n for repo, n in done)) != list(range(count + 1)):
+        errors.append("not every payload was processed")
+    # Failed payloads included: a retry must not be overtaken by later pushes
+    for r in range(repos):
+        seq = [n for repo, n in done if repo == "repo%u" % r]
+        if seq != sorted(seq):
+            errors.append("repo%u processed out of order: %s" % (r, seq))
+    if max(held) >= pool.max_pending:
+        errors.append("polled for more while holding %u payloads (max_pending %u)" % (max(held), pool.max_pending))
+    if standin.requests['delete'] >= count:
+        errors.append("acks weren't batched (%u delete requests)" % standin.requests['delete'])
+    if lone > 2:
+        errors.append("a lone payload took %.1fs to be acknowledged, acks are waiting for the long-poll" % lone)
+    print(queue.report())
+    print("Drained %u payloads (%u failing once) in %.2fs with %u gets and %u delete requests, lone payload acked after %.2fs" % (
+        count, len(failed), took, standin.requests['get'], standin.requests['delete'], lone))
+    for error in errors:
+        print("FAIL: %s" % error)
+    print("FAIL" if errors else "OK")
+    return not errors
+
 
 # Spawn thread, detach and return
 def main():
+    global SEEN, DB
     config = yaml.load(open('gitbox-poller.yaml'))
+    db = config.get('db', {})
+    DB = Database(
+        config['database'],
+        ids_ttl = int(db.get('ids_ttl', 300)),
+        flush_size = int(db.get('flush_size', 50)),
+        flush_interval = float(db.get('flush_interval', 2)),
+        )
+    dedup = config.get('dedup', {})
+    SEEN = SeenCache(
+        size = int(dedup.get('size', 10000)),
+        ttl = int(dedup.get('ttl', 86400)),
+        database = DB if dedup.get('persist', True) else None,
+        )
+    sqs = config.get('sqs', {})
+    queue = QueueClient(
+        config['sqs_api'],
+        wait = int(sqs.get('wait', 20)),
+        visibility = int(sqs.get('visibility', 300)),
+        batch_ack = bool(sqs.get('batch_ack', False)),
+        ack_batch = int(sqs.get('ack_batch', 10)),
+        ack_interval = float(sqs.get('ack_interval', 1)),
+        min_interval = float(sqs.get('min_interval', 0.5)),
+        max_interval = float(sqs.get('max_interval', 5)),
+        )
+    # Don't lose buffered push log entries and acks when systemd stops us
+    def stop(signum, frame):
+        DB.flush(force = True)
+        with queue.ack_lock:
+            queue.flush_acks()
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, stop)
+    # Acks and push log rows go out from their own thread, receive() may long-poll for a while
+    start_flusher(queue, DB, min(queue.ack_interval, DB.flush_interval))
     # Forever fetch items and process them...
-    SQS_URL_GET = "%s/get" % config['sqs_api']
-    SQS_URL_DELETE = "%s/delete" % config['sqs_api']
+    pool = RepoPool(config, int(config.get('workers', 4)), queue, max_pending = int(config.get('max_pending', 0)))
+    last_report = time.time()
     while True:
-        try:
-            payloads = requests.get(SQS_URL_GET).json()['payloads']
-        except:
-            payloads = []
-        for payload in payloads:
-            try:
-                parse_payload(config, payload['payload'])
-                print("Processed %s, removing from queue..." % payload['id'][:31])
-                rv = requests.get("%s?id=%s" % (SQS_URL_DELETE, payload['id'])).text
-                print(rv)
-            except Exception as e:
-                print("Payload %s failed to process, putting back in queue for now" % payload['id'][:31])
-        # If we had payloads, don't sleep too long. Otherwise, do sleep long
-        if payloads:
-            time.sleep(1)
-        else:
-            time.sleep(5)
+        pool.wait_for_room()
+        for payload in queue.receive():
+            pool.submit(payload)
+        if time.time() - last_report >= int(config.get('metrics_interval', 600)):
+            print(pool.metrics.report())
+            print(SEEN.report())
+            print(queue.report())
+            last_report = time.time()
 
 if __name__ == '__main__':
-    main()
+    if '--benchmark' in sys.argv:
+        benchmark()
+    elif '--selftest' in sys.argv:
+        sys.exit(0 if selftest() else 1)
+    else:
+        main()
@@ -19,6 +19,8 @@ import time
 import logging
 import atexit
 import signal
+import collections
+import threading
 
 # define a megabyte and gigabyte
 MB = (2 ** 20)
@@ -28,6 +30,8 @@ GB = (2 ** 30)
 ME = socket.gethostname()
 PIDFILE = "/var/run/kif.pid"
 CONFIG = None
+MATCHER = None
+SAMPLER = None
 
 # Default to checking triggers every N seconds.
 DEFAULT_INTERVAL = 300
@@ -55,34 +59,95 @@ def notifyHipchat(room, token, msg, notify = False):
     requests.post('https://api.hipchat.com/v1/rooms/message', data = payload)
 
 
+# Which process metrics each trigger type needs
+TRIGGER_METRICS = {
+    'maxmemory': ('mem', 'mempct'),
+    'maxfds': ('fds',),
+    'maxconns': ('conns',),
+    'maxlocalconns': ('conns',),
+    'maxage': ('age',),
+    'state': ('state',),
+}
+METRICS = ('mem', 'mempct', 'fds', 'age', 'state', 'conns')
+
+
+class ProcessSnapshot(object):
+    """ One pass over the process table. Command lines are read up front, since
+    every rule needs them; everything else (username, memory, fds, connections,
+    age, state) is fetched the first time some rule asks for it, and then
+    cached for the rest of the run, so each is read at most once per PID. """
+    def __init__(self):
+        self.procs = {}     # pid -> psutil.Process
+        self.cmdlines = {}  # pid -> command line, as a list
+        self.cache = {}     # (pid, metric) -> value
+        self.total_memory = None
+        for p in psutil.process_iter():
+            try:
+                pinfo = p.as_dict(attrs=['pid', 'name', 'cmdline'])
+                content = pinfo['cmdline']
+                if not content:
+                    content = pinfo['name'] # Fall back if no cmdline present
+                pid = pinfo['pid']
+                if len(content) > 0 and len(content[0]) > 0:
+                    content = [c for c in content if len(c) > 0]
+                    self.cmdlines[pid] = content
+                    self.procs[pid] = p
+            except (psutil.ZombieProcess, psutil.AccessDenied, psutil.NoSuchProcess):
+                print("Could not access process, it might have gone away...")
+                continue
+
+    def get(self, pid, metric):
+        key = (pid, metric)
+        if key in self.cache:
+            return self.cache[key]
+        proc = self.procs[pid]
+        if metric in ('mem', 'mempct'):
+            # Same sum as proc.memory_percent(), without a second memory_info()
+            if self.total_memory is None:
+                self.total_memory = psutil.virtual_memory().total
+            rss = proc.memory_info().rss
+            self.cache[(pid, 'mem')] = rss
+            self.cache[(pid, 'mempct')] = 100.0 * rss / self.total_memory
+        elif metric == 'conns':
+            # (all connections, connections to the local network)
+            connections = proc.connections()
+            local = 0
+            for connection in connections:
+                if connection.raddr and connection.raddr[0]:
+                    if RE_LOCAL_IP.match(connection.raddr[0]) \
+                       or connection.raddr[0] == '::1':
+                        local += 1
+            self.cache[key] = (len(connections), local)
+        elif metric == 'fds':
+            self.cache[key] = proc.num_fds()
+        elif metric == 'age':
+            self.cache[key] = time.time() - proc.create_time()
+        elif metric == 'state':
+            self.cache[key] = proc.status()
+        elif metric == 'username':
+            self.cache[key] = proc.username()
+        return self.cache[key]
+
+
 class ProcessInfo(object):
-    def __init__(self, pid=None):
+    def __init__(self, pid=None, snapshot=None, metrics=METRICS):
+        # Metrics no trigger asked for stay zeroed. With no pid, this instance
+        # will aggregate values across multiple processes.
+        self.mem = 0
+        self.mempct = 0
+        self.fds = 0
+        self.age = 0
+        self.state = ''  # can't aggregate state, but needs a value
+        self.conns = 0
+        self.conns_local = 0
         if pid is None:
-            # This instance will aggregate values across multiple processes,
-            # so we'll zero the numerics.
-            self.mem = 0
-            self.mempct = 0
-            self.fds = 0
-            self.age = 0
-            self.state = ''  # can't aggregate state, but needs a value
-            self.conns = 0
-            self.conns_local = 0
             return
 
-        proc = psutil.Process(pid)
-        self.mem = proc.memory_info().rss
-        self.mempct = proc.memory_percent()
-        self.fds = proc.num_fds()
-        self.age = time.time() - proc.create_time()
-        self.state = proc.status()
-
-        self.conns = len(proc.connections())
-        self.conns_local = 0
-        for connection in proc.connections():
-            if connection.raddr and connection.raddr[0]:
-                if RE_LOCAL_IP.match(connection.raddr[0]) \
-                   or connection.raddr[0] == '::1':
-                    self.conns_local += 1
+        for metric in metrics:
+            if metric == 'conns':
+                self.conns, self.conns_local = snapshot.get(pid, 'conns')
+            else:
+                setattr(self, metric, snapshot.get(pid, metric))
 
     def accumulate(self, other):
         self.mem += other.mem
@@ -96,28 +161,88 @@ class ProcessInfo(object):
 RE_LOCAL_IP = re.compile(r'^(10|192|127)\.')
 
 
-def getuser(pid):
-    proc = psutil.Process(pid)
-    return proc.username()
+class RuleMatcher(object):
+    """ The procid/uid/ignore parts of all rules, compiled into lookups so a
+    process table can be matched against every rule in one pass: exact
+    command lines in a dict, substrings behind one combined regex (most
+    processes match none of them), rules bucketed by uid, and ignore pid
+    files read once per run rather than once per candidate process. """
+    def __init__(self, rules):
+        self.rules = rules
+        self.exact = {}       # tuple(cmdline) -> [rule ids]
+        self.substrings = {}  # substring -> [rule ids]
+        self.uids = {}        # username -> [rule ids]
+        for id, rule in rules.items():
+            procid = rule.get('procid')
+            if isinstance(procid, list):
+                self.exact.setdefault(tuple(procid), []).append(id)
+            elif procid is not None:
+                self.substrings.setdefault(procid, []).append(id)
+            if 'uid' in rule:
+                self.uids.setdefault(rule['uid'], []).append(id)
+        self.prefilter = None
+        if self.substrings:
+            patterns = sorted(self.substrings, key = len, reverse = True)
+            self.prefilter = re.compile("|".join(re.escape(p) for p in patterns))
+
+    def pidfiles(self):
+        """ Reads each rule's ignorepidfile, returns {rule id: pid} """
+        ignored = {}
+        contents = {}
+        for id, rule in self.rules.items():
+            if 'ignorepidfile' in rule:
+                path = rule['ignorepidfile']
+                if path not in contents:
+                    try:
+                        contents[path] = int(open(path).read())
+                    except Exception as err:
+                        print(err)
+                        contents[path] = None
+                ignored[id] = contents[path]
+        return ignored
+
+    def ignored(self, rule, cmdline):
+        ignore = rule.get('ignore')
+        if isinstance(ignore, list):
+            return cmdline == ignore
+        elif ignore is not None:
+            return " ".join(cmdline) == ignore
+        return False
+
+    def match(self, snapshot):
+        """ Returns {rule id: [pids]} for all processes in a snapshot """
+        ignorepids = self.pidfiles()
+        matches = dict((id, []) for id in self.rules)
+        for pid, cmdline in snapshot.cmdlines.items():
+            ids = list(self.exact.get(tuple(cmdline), []))
+            if self.prefilter:
+                joined = " ".join(cmdline)
+                if self.prefilter.search(joined):
+                    for substring, sids in self.substrings.items():
+                        if substring in joined:
+                            ids += sids
+            if self.uids:
+                try:
+                    ids += self.uids.get(snapshot.get(pid, 'username'), [])
+                except (psutil.AccessDenied, psutil.NoSuchProcess):
+                    pass
+            for id in ids:
+                rule = self.rules[id]
+                if pid in matches[id] or self.ignored(rule, cmdline):
+                    continue
+                if ignorepids.get(id) == pid:
+                    print("Ignoring %u, matches pid file %s!" % (pid, rule['ignorepidfile']))
+                    continue
+                matches[id].append(pid)
+        return matches
 
 
-# getprocs: Get all processes and their command line stack
-def getprocs():
-    procs = {}
-    for p in psutil.process_iter():
-        try:
-            pinfo = p.as_dict(attrs=['pid', 'name', 'username', 'status', 'cmdline'])
-            content = pinfo['cmdline']
-            if not content:
-                content = pinfo['name'] # Fall back if no cmdline present
-            pid = pinfo['pid']
-            if len(content) > 0 and len(content[0]) > 0:
-                content = [c for c in content if len(c) > 0]
-                procs[pid] = content
-        except (psutil.ZombieProcess, psutil.AccessDenied, psutil.NoSuchProcess):
-            print("Could not access process, it might have gone away...")
-            continue
-    return procs
+def ruleMetrics(rule):
+    """ The set of metrics a rule's triggers look at """
+    metrics = set()
+    for trigger in rule.get('triggers', {}):
+        metrics.update(TRIGGER_METRICS.get(trigger, ()))
+    return metrics
 
 
 
@@ -214,8 +339,198 @@ def checkTriggers(id, info, triggers, dead = False):
                 return lstr
     return None
 
+def makeAction(rule, pids, trigger):
+    """ The action to take when a rule's trigger fires for some pids """
+    action = {
+        'pids': [],
+        'trigger': trigger,
+        'runlist': [],
+        'notify': rule.get('notify', None),
+        'kills': {}
+    }
+    if 'runlist' in rule and len(rule['runlist']) > 0:
+        action['runlist'] = rule['runlist']
+        if 'timeout' in rule:
+            action['timeout'] = rule['timeout']
+    if 'kill' in rule and rule['kill'] == True:
+        sig = 9
+        if 'killwith' in rule:
+            sig = int(rule['killwith'])
+        for pid in pids:
+            action['kills'][pid] = sig
+    return action
+
+
+def parseRate(value):
+    """ Parses a rate trigger value such as '100mb/1m', '2x/5m' or '500/10m'
+    into (amount, is_factor, window in seconds) """
+    amount, window = str(value).lower().split('/')
+    factor = False
+    if amount.endswith('x'):
+        amount = float(amount[:-1])
+        factor = True
+    elif amount.endswith('mb'):
+        amount = int(amount[:-2]) * MB
+    elif amount.endswith('gb'):
+        amount = int(amount[:-2]) * GB
+    else:
+        amount = int(amount)
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    if window[-1] in units:
+        window = int(window[:-1] or 1) * units[window[-1]]
+    else:
+        window = int(window)
+    return amount, factor, window
+
+
+def checkRates(id, history, triggers):
+    """ Checks rate triggers (memrate, fdrate) against a sample history, a
+    list of (time, rss, fds) tuples, oldest first. Unlike checkTriggers, this
+    only prints when something fires, as it runs every sample interval. """
+    for trigger, value in triggers.items():
+        if trigger not in RATE_TRIGGERS or len(history) < 2:
+            continue
+        field, what = RATE_TRIGGERS[trigger]
+        amount, factor, window = parseRate(value)
+        now = history[-1]
+        # Compare against the oldest sample still inside the window
+        for then in history:
+            if then[0] >= now[0] - window:
+                break
+        if factor:
+            fired = then[field] > 0 and now[field] >= then[field] * amount
+        else:
+            fired = now[field] - then[field] > amount
+        if fired:
+            lstr = "      - Process '%s' went from %u to %u %s in %u seconds, max allowed growth is %s" % (id, then[field], now[field], what, now[0] - then[0], value)
+            print(lstr)
+            print("    - Trigger fired!")
+            return lstr
+    return None
+
+
+# Rate triggers: the (time, rss, fds) field they look at, and what it's called
+RATE_TRIGGERS = {
+    'memrate': (1, 'bytes of memory'),
+    'fdrate': (2, 'FDs'),
+}
+
+
+class Sampler(object):
+    """ Samples the memory and fd counts of processes matched by rules with
+    rate triggers, straight from /proc, every few seconds between full runs.
+    Each process (or combined rule) gets a ring buffer of recent samples.
+    Time spent sampling is tracked; if a tick costs more than BUDGET of the
+    sample interval, the interval is doubled to keep the overhead down, and
+    halved again (down to the configured interval) once sampling is cheap
+    enough that the shorter interval would stay well within budget. """
+    BUDGET = 0.01
+
+    def __init__(self, interval, history, max_interval, max_pids = 1000):
+        self.interval = interval
+        self.base_interval = interval
+        self.history = history
+        self.max_interval = max_interval
+        self.max_pids = max_pids
+        self.pagesize = os.sysconf('SC_PAGE_SIZE')
+        self.rules = {}
+        self.watching = {}   # rule id -> [pids]
+        self.needs = {}      # pid -> (read rss?, read fds?)
+        self.buffers = {}    # pid or ('combined', rule id) -> deque of samples
+        self.ticks = 0
+        self.busy = 0.0
+        self.started = time.time()
+
+    def watch(self, rules, matches):
+        """ Picks the processes to sample from a full set of rule matches """
+        self.rules = rules
+        previous = self.watching
+        self.watching = {}
+        self.needs = {}
+        for id, pids in matches.items():
+            triggers = rules[id].get('triggers', {})
+            if not pids or not any(t in RATE_TRIGGERS for t in triggers):
+                continue
+            pids = pids[:self.max_pids]
+            self.watching[id] = pids
+            for pid in pids:
+                rss, fds = self.needs.get(pid, (False, False))
+                self.needs[pid] = (rss or 'memrate' in triggers, fds or 'fdrate' in triggers)
+        # A combined total over a different set of processes isn't comparable
+        # with the samples before it, so start that rule's history over
+        for id, pids in self.watching.items():
+            if set(pids) != set(previous.get(id, [])):
+                self.buffers.pop(('combined', id), None)
+        keep = set(self.needs) | set(('combined', id) for id in self.watching)
+        for key in list(self.buffers):
+            if key not in keep:
+                del self.buffers[key]
+
+    def buffer(self, key):
+        if key not in self.buffers:
+            size = max(2, int(self.history / self.interval) + 1)
+            self.buffers[key] = collections.deque(maxlen = size)
+        return self.buffers[key]
+
+    def sample(self):
+        start = time.time()
+        samples = {}
+        for pid, (rss, fds) in self.needs.items():
+            try:
+                mem = nfds = 0
+                if rss:
+                    with open('/proc/%u/statm' % pid) as f:
+                        mem = int(f.read().split()[1]) * self.pagesize
+                if fds:
+                    nfds = len(os.listdir('/proc/%u/fd' % pid))
+                samples[pid] = (start, mem, nfds)
+                self.buffer(pid).append(samples[pid])
+            except (IOError, OSError):
+                continue # process went away
+        for id, pids in self.watching.items():
+            if self.rules[id].get('combine') == True:
+                total = [samples[pid] for pid in pids if pid in samples]
+                self.buffer(('combined', id)).append((start, sum(x[1] for x in total), sum(x[2] for x in total)))
+        took = time.time() - start
+        self.ticks += 1
+        self.busy += took
+        if took > self.BUDGET * self.interval and self.interval < self.max_interval:
+            self.interval = min(self.interval * 2, self.max_interval)
+            print("Sampling took %.1fms, backing off to every %us" % (took * 1000, self.interval))
+        elif took < self.BUDGET * self.interval / 4 and self.interval > self.base_interval:
+            self.interval = max(self.interval / 2, self.base_interval)
+            print("Sampling took %.1fms, stepping back to every %us" % (took * 1000, self.interval))
+
+    def check(self):
+        """ Runs the rate triggers against the sample buffers """
+        actions = []
+        for id, pids in self.watching.items():
+            rule = self.rules[id]
+            if rule.get('combine') == True:
+                keys = [(('combined', id), pids)]
+            else:
+                keys = [(pid, [pid]) for pid in pids]
+            for key, kpids in keys:
+                err = checkRates(id, list(self.buffers.get(key, [])), rule['triggers'])
+                if err:
+                    actions.append(makeAction(rule, kpids, err))
+                    self.buffers.pop(key, None) # Start over, so we don't fire again right away
+        return actions
+
+    def stats(self):
+        elapsed = max(time.time() - self.started, 1)
+        return "Sampler: watching %u processes, %u ticks, %.2fms per tick, %.3f%% of wall time" % (
+            len(self.needs), self.ticks, 1000 * self.busy / max(self.ticks, 1), 100 * self.busy / elapsed)
+
+
 def scanForTriggers(config):
-    procs = getprocs() # get all current processes
+    global MATCHER
+    if MATCHER is None or MATCHER.rules is not config['rules']:
+        MATCHER = RuleMatcher(config['rules'])
+    snapshot = ProcessSnapshot() # get all current processes
+    matches = MATCHER.match(snapshot)
+    if SAMPLER:
+        SAMPLER.watch(config['rules'], matches)
     actions = []
 
     ### TODO: reindent
@@ -225,65 +540,19 @@ def scanForTriggers(config):
         for id, rule in config['rules'].items():
             print("- Running rule %s" % id)
             # Is this process running here?
-            pids = []
             if 'procid' in rule:
-                procid = rule['procid']
-                print("  - Checking for process %s" % procid)
-                for xpid, cmdline in procs.items():
-                    addit = False
-                    if isinstance(procid, str):
-                        if " ".join(cmdline).find(rule['procid']) != -1:
-                            addit = True
-                    elif isinstance(procid, list):
-                        if cmdline == procid:
-                            addit = True
-                    if addit:
-                        if not ('ignore' in rule):
-                            addit = True
-                        elif isinstance(rule['ignore'], str) and " ".join(cmdline) != rule['ignore']:
-                            addit = True
-                        elif isinstance(rule['ignore'], list) and cmdline != rule['ignore']:
-                            addit = True
-                        if 'ignorepidfile' in rule:
-                            try:
-                                ppid = int(open(rule['ignorepidfile']).read())
-                                if ppid == xpid:
-                                    print("Ignoring %u, matches pid file %s!" % (ppid, rule['ignorepidfile']))
-                                    addit = False
-                            except Exception as err:
-                                print(err)
-                        if addit:
-                            pids.append(xpid)
-            if 'uid' in rule:
-                for xpid, cmdline in procs.items():
-                    uid = getuser(xpid)
-                    if uid == rule['uid']:
-                        addit = False
-                        if not ('ignore' in rule):
-                            addit = True
-                        elif isinstance(rule['ignore'], str) and " ".join(cmdline) != rule['ignore']:
-                            addit = True
-                        elif isinstance(rule['ignore'], list) and cmdline != rule['ignore']:
-                            addit = True
-                        if 'ignorepidfile' in rule:
-                            try:
-                                ppid = int(open(rule['ignorepidfile']).read())
-                                if ppid == xpid:
-                                    print("Ignoring %u, matches pid file %s!" % (ppid, rule['ignorepidfile']))
-                                    addit = False
-                            except Exception as err:
-                                print(err)
-                        if addit:
-                            pids.append(xpid)
+                print("  - Checking for process %s" % rule['procid'])
+            pids = matches[id]
 
             # If proc is running, analyze it
             analysis = ProcessInfo()  # no pid. accumulator.
+            metrics = ruleMetrics(rule)
             for pid in pids:
                 print("  - Found process at PID %u" % pid)
 
                 try:
                     # Get all relevant data from this PID
-                    info = ProcessInfo(pid)
+                    info = ProcessInfo(pid, snapshot, metrics)
     
                     # If combining, combine into the analysis hash
                     if 'combine' in rule and rule['combine'] == True:
@@ -292,22 +561,7 @@ def scanForTriggers(config):
                         # If running a per-pid test, run it:
                         err = checkTriggers(id, info, rule['triggers'])
                         if err:
-                            action = {
-                                'pids': [],
-                                'trigger': "",
-                                'runlist': [],
-                                'notify': rule.get('notify', None),
-                                'kills': {}
-                            }
-                            if 'runlist' in rule and len(rule['runlist']) > 0:
-                                action['runlist'] = rule['runlist']
-                            if 'kill' in rule and rule['kill'] == True:
-                                sig = 9
-                                if 'killwith' in rule:
-                                    sig = int(rule['killwith'])
-                                action['kills'][pid] = sig
-                            action['trigger'] = err
-                            actions.append(action)
+                            actions.append(makeAction(rule, [pid], err))
                 except:
                     print("Could not analyze proc %u, bailing!" % pid)
                     continue
@@ -316,23 +570,7 @@ def scanForTriggers(config):
                 if 'combine' in rule and rule['combine'] == True:
                     err = checkTriggers(id, analysis, rule['triggers'])
                     if err:
-                        action = {
-                            'pids': [],
-                            'trigger': "",
-                            'runlist': [],
-                            'notify': rule.get('notify', None),
-                            'kills': {}
-                        }
-                        if 'runlist' in rule and len(rule['runlist']) > 0:
-                            action['runlist'] = rule['runlist']
-                        if 'kill' in rule and rule['kill'] == True:
-                            sig = 9
-                            if 'killwith' in rule:
-                                sig = int(rule['killwith'])
-                            for ypid in pids:
-                                action['kills'][ypid] = sig
-                        action['trigger'] = err
-                        actions.append(action)
+                        actions.append(makeAction(rule, pids, err))
             else:
                 print("  - No matching processes found")
                 
@@ -366,76 +604,124 @@ def main(config):
     print('KIF run finished!')
 
 
-def run_actions(config, actions):
-        ### TODO: reindent
+def run_command(item, timeout):
+    """ Runs a runlist command through the shell. If it hasn't finished
+    after timeout seconds, it and anything it started are killed.
+    Returns (succeeded, output, note) """
+    proc = subprocess.Popen(item, shell = True, stdout = subprocess.PIPE,
+                            stderr = subprocess.STDOUT, preexec_fn = os.setsid)
+    expired = []
+    def expire():
+        expired.append(True)
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+    timer = threading.Timer(timeout, expire)
+    timer.start()
+    try:
+        output = proc.communicate()[0]
+    finally:
+        timer.cancel()
+    if not isinstance(output, str):
+        output = output.decode('utf-8', 'replace')
+    if expired:
+        return False, output, "timed out after %us" % timeout
+    if proc.returncode != 0:
+        return False, output, "failed!: %s" % output
+    return True, output, "success"
+
+
+def run_action(action, timeout):
+    """ Runs one action's runlist (in order) and kills, returns the outcome """
+    result = {'lines': [], 'goods': 0, 'bads': 0}
+    start = time.time()
+    for item in action['runlist']:
+        if not args.debug:
+            ok, output, note = run_command(item, timeout)
+            if not ok:
+                print("command failed: %s" % note)
+        else:
+            ok, note = True, "disabled due to --debug"
+        result['lines'].append("- %s (%s)" % (item, note))
+        if ok:
+            result['goods'] += 1
+        else:
+            result['bads'] += 1
+    for pid, sig in action['kills'].items():
+        line = "- KILL PID %u with sig %u" % (pid, sig)
+        if not args.debug:
+            try:
+                os.kill(pid, sig)
+            except OSError:
+                line += "(failed, no such process!)"
+        else:
+            line += " (disabled due to --debug flag)"
+        result['lines'].append(line)
+        result['goods'] += 1
+    result['took'] = time.time() - start
+    return result
 
-        goods = 0
-        bads = 0
-        triggered_total = 0
-        email_triggers = ""
-        email_actions = ""
-        
-        for action in actions:
-            triggered_total += 1
-            print("Following triggers were detected:")
-            print("- %s" % action['trigger'])
-            if action.get('notify', 'email') in [None, 'email']:
-                email_triggers += "- %s\n" % action['trigger']
-            print("Running triggered commands:")
-            rloutput = ""
-            for item in action['runlist']:
-                print("- %s" % item)
-                rloutput += "- %s" % item
-                if action.get('notify', 'email') in [None, 'email']:
-                    email_actions += "- %s" % item
-                try:
-                    if not args.debug:
-                        subprocess.check_output(item, shell = True, stderr=subprocess.STDOUT)
-                        rloutput += " (success)"
-                        if action.get('notify', 'email') in [None, 'email']:
-                            email_actions += " (success)"
-                    else:
-                        print("(disabled due to --debug flag)")
-                        rloutput += " (disabled due to --debug)"
-                        if action.get('notify', 'email') in [None, 'email']:
-                            email_actions += " (disabled due to --debug)"
-                    goods += 1
-                except subprocess.CalledProcessError as e:
-                    print("command failed: %s" % e.output)
-                    rloutput += " (failed!: %s)" % e.output
-                    if action.get('notify', 'email') in [None, 'email']:
-                        email_actions += " (failed!: %s)" % e.output
-                    bads += 1
-                rloutput += "\n"
-                if action.get('notify', 'email') in [None, 'email']:
-                    email_actions += "\n"
-            for pid, sig in action['kills'].items():
-                print("- KILL PID %u with sig %u" % (pid, sig))
-                rloutput += "- KILL PID %u with sig %u" % (pid, sig)
-                if action.get('notify', 'email') in [None, 'email']:
-                    email_actions += "- KILL PID %u with sig %u" % (pid, sig)
-                if not args.debug:
-                    try:
-                        os.kill(pid, sig)
-                    except OSError:
-                        email_actions += "(failed, no such process!)"
-                else:
-                    print(" (disabled due to --debug flag)")
-                    rloutput += " (disabled due to --debug flag)"
-                    if action.get('notify', 'email') in [None, 'email']:
-                        email_actions += " (disabled due to --debug flag)"
-                rloutput += "\n"
-                if action.get('notify', 'email') in [None, 'email']:
-                    email_actions += "\n"
-                goods += 1
-            print("%u calls succeeded, %u failed." % (goods, bads))
-
-        if email_actions and 'notifications' in config and 'email' in config['notifications']:
-            ecfg = config['notifications']['email']
-            if 'rcpt' in ecfg and 'from' in ecfg:
-                subject = "[KIF] events triggered on %s"  % ME
-                msg = TEMPLATE_EMAIL % (ME, email_triggers, email_actions)
-                notifyEmail(ecfg['from'], ecfg['rcpt'], subject, msg)
+
+def run_actions(config, actions):
+    """ Runs the actions' runlists concurrently (at most runlists.concurrency
+    at a time, each command limited to runlists.timeout seconds), then sends
+    one notification covering all of them. """
+    rcfg = config.get('runlists', {})
+    concurrency = int(rcfg.get('concurrency', 4))
+    timeout = int(rcfg.get('timeout', 300))
+
+    # Several processes firing the same rule would otherwise run the same
+    # runlist (say, a service restart) several times, now concurrently
+    merged = []
+    byrunlist = {}
+    for action in actions:
+        key = tuple(action['runlist'])
+        if key and key in byrunlist:
+            first = byrunlist[key]
+            first['trigger'] += "\n- %s" % action['trigger']
+            first['kills'].update(action['kills'])
+        else:
+            action = dict(action, kills = dict(action['kills']))
+            if key:
+                byrunlist[key] = action
+            merged.append(action)
+    actions = merged
+
+    results = [None] * len(actions)
+    slots = threading.Semaphore(concurrency)
+    def worker(i, action):
+        with slots:
+            try:
+                results[i] = run_action(action, int(action.get('timeout', timeout)))
+            except Exception as err:
+                results[i] = {'lines': ["- could not run actions: %s" % err], 'goods': 0, 'bads': 1, 'took': 0}
+    threads = [threading.Thread(target = worker, args = (i, action)) for i, action in enumerate(actions)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    email_triggers = ""
+    email_actions = ""
+    for action, result in zip(actions, results):
+        print("Following triggers were detected:")
+        print("- %s" % action['trigger'])
+        print("Running triggered commands:")
+        for line in result['lines']:
+            print(line)
+        print("%u calls succeeded, %u failed, took %.2fs." % (result['goods'], result['bads'], result['took']))
+        if action.get('notify', 'email') in [None, 'email']:
+            email_triggers += "- %s\n" % action['trigger']
+            email_actions += "".join(line + "\n" for line in result['lines'])
+            email_actions += "  (took %.2fs)\n" % result['took']
+
+    if email_actions and 'notifications' in config and 'email' in config['notifications']:
+        ecfg = config['notifications']['email']
+        if 'rcpt' in ecfg and 'from' in ecfg:
+            subject = "[KIF] events triggered on %s"  % ME
+            msg = TEMPLATE_EMAIL % (ME, email_triggers, email_actions)
+            notifyEmail(ecfg['from'], ecfg['rcpt'], subject, msg)
 
 TEMPLATE_EMAIL = """Hullo there,
 
@@ -605,14 +891,43 @@ if 'logging' in CONFIG and 'logfile' in CONFIG['logging']:
     logging.basicConfig(filename=CONFIG['logging']['logfile'], format='[%(asctime)s]: %(message)s', level=logging.INFO)
 
 
+def loop(config):
+    """ Runs kif until stopped. With daemon.sample_interval set, processes
+    that rate triggers care about are sampled in between full runs. """
+    dcfg = config.get('daemon', { })
+    interval = int(dcfg.get('interval', DEFAULT_INTERVAL))
+    sample_interval = dcfg.get('sample_interval')
+    if not sample_interval or 'rules' not in config or not os.path.isdir('/proc'):
+        while True:
+            main(config)
+            time.sleep(interval)
+
+    global SAMPLER
+    SAMPLER = Sampler(float(sample_interval), int(dcfg.get('sample_history', 600)), interval)
+    rescan = int(dcfg.get('rescan', 60))
+    next_run = next_rescan = 0
+    while True:
+        now = time.time()
+        if now >= next_run:
+            main(config)
+            next_run = now + interval
+            next_rescan = now + rescan
+            print(SAMPLER.stats())
+        elif now >= next_rescan:
+            # Pick up new processes without doing a full run
+            SAMPLER.watch(config['rules'], MATCHER.match(ProcessSnapshot()))
+            next_rescan = now + rescan
+        SAMPLER.sample()
+        actions = SAMPLER.check()
+        if actions:
+            run_actions(config, actions)
+        time.sleep(SAMPLER.interval)
+
+
 ## Daemon class
 class MyDaemon(Daemonize):
     def run(self, args):
-        interval = int(CONFIG.get('daemon', { })
-                       .get('interval', DEFAULT_INTERVAL))
-        while True:
-            main(CONFIG)
-            time.sleep(interval)
+        loop(CONFIG)
 
 # Get started!
 if args.stop:
@@ -629,10 +944,6 @@ else:
         daemon = MyDaemon(PIDFILE)
         daemon.start(args)
     elif args.foreground:
-        interval = int(CONFIG.get('daemon', { })
-                       .get('interval', DEFAULT_INTERVAL))
-        while True:
-            main(CONFIG)
-            time.sleep(interval)
+        loop(CONFIG)
     else:
         main(CONFIG)
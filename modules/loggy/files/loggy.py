@@ -30,13 +30,16 @@ import time, datetime
 import json
 import re
 import socket
-import hashlib, random
+import hashlib, random, uuid
 from collections import defaultdict, namedtuple
 from threading import Thread
 import atexit, signal, inspect
 from threading import Lock
 import subprocess, collections, argparse, grp, pwd, shutil
 import ConfigParser
+import BaseHTTPServer
+import Queue
+import io
 import platform
 import syslog
 import base64
@@ -52,7 +55,7 @@ elif osname == "freebsd":
     from watchdog.events import PatternMatchingEventHandler
     
 # ElasticSearch
-from elasticsearch import Elasticsearch, helpers
+from elasticsearch import Elasticsearch, helpers, TransportError
 
 config = ConfigParser.ConfigParser()
 dd_config = ConfigParser.ConfigParser()
@@ -180,6 +183,82 @@ tuples = {
         )
 }
 
+# Which first characters each regex above can possibly start with.
+# Lines whose first byte no regex accepts are dropped without any matching.
+leaders = {
+    'apache_access': re.compile(r"[\d\.]"),
+    'apache_error':  re.compile(r"\["),
+    'syslog':        re.compile(r"\S"),
+    'fail2ban':      re.compile(r"\S"),
+    'rsync':         re.compile(r"\S"),
+    'pylogs':        re.compile(r"\S"),
+    'qmail':         re.compile(r"@"),
+    'lastlog':       re.compile(r"[a-z0-9]"),
+}
+
+# Precedence when a line could match several types. This is the order the
+# old one-regex-at-a-time loop walked the regexes dict in on Python 2.7.
+logtype_order = ['lastlog', 'syslog', 'apache_access', 'fail2ban', 'qmail',
+                 'apache_error', 'rsync', 'pylogs']
+
+JSON_PREFIX = "<%JSON:"
+re_json_line = re.compile(r"^<%JSON:([^>%]+)%>\s*(.+)")
+
+
+class LineClassifier:
+    """Assigns log lines to a log type in a single regex pass.
+
+    For each line we first try the type last seen in the same file (log files
+    rarely mix formats), then a combined alternation of only those regexes
+    that can start with the line's first character. Combined regexes are
+    built lazily and cached per leading character."""
+
+    def __init__(self, order = logtype_order):
+        self.order = order
+        self.affinity = {}
+        self.combined = {}
+        self.fields = {}
+        for r in order:
+            names = list(regexes[r].groupindex.keys())
+            self.fields[r] = (names, ["%s__%s" % (r, f) for f in names])
+
+    def combine(self, char):
+        """Build (or fetch) the alternation for lines starting with char"""
+        if char in self.combined:
+            return self.combined[char]
+        alts = []
+        for r in self.order:
+            if leaders[r].match(char):
+                # Prefix group names with the log type so they don't clash
+                src = re.sub(r"\(\?P<", "(?P<%s__" % r, regexes[r].pattern)
+                alts.append("(?P<%s>%s)" % (r, src))
+        rx = re.compile("|".join(alts)) if alts else None
+        self.combined[char] = rx
+        return rx
+
+    def classify(self, path, line):
+        """Returns (logtype, fields) for a line, or (None, None)"""
+        if not line:
+            return None, None
+        char = line[0]
+        r = self.affinity.get(path)
+        if r and leaders[r].match(char):
+            match = regexes[r].match(line)
+            if match:
+                return r, match.groupdict()
+        rx = self.combine(char)
+        if rx:
+            match = rx.match(line)
+            if match:
+                # The outer type group closes last, so it is always lastgroup
+                r = match.lastgroup
+                self.affinity[path] = r
+                names, groups = self.fields[r]
+                return r, dict(zip(names, match.group(*groups)))
+        return None, None
+
+classifier = LineClassifier()
+
 
 class Daemonize:
 	"""A generic daemon class.
@@ -303,54 +382,172 @@ class Daemonize:
 filehandles = {}
 json_pending = {}
 last_push = {}
+checkpoints = None
 
 for t in tuples:
     json_pending[t] = []
     last_push[t] = time.time()
 
-gotindex = {}
 
 
 
-class NodeThread(Thread):
-    def assign(self, json, logtype, xes):
-        self.json = json
-        self.logtype = logtype
+class Enricher:
+    """Adds our own fields to each document before it is shipped.
+
+    The fields that are the same for every document (node name, key
+    fingerprints, tags) are built once and copied in with a single update,
+    and @timestamp is only re-formatted when the second changes."""
+
+    re_url = re.compile(r"(GET|POST)\s+(.+)\s+HTTP/.+")
+
+    def __init__(self):
+        self.block = None
+        self.stamp = (0, None)
+
+    def static(self):
+        # Built on first use, as the tags are only read after startup
+        if self.block is None:
+            block = {
+                '@version': 2,
+                'host': hostname,
+                '@node': hostname,
+                '@fingerprint': FINGERPRINT,
+                '@fingerprint_sha': FINGERPRINT_SHA,
+            }
+            if mytags:
+                block['@tags'] = mytags
+            self.block = block
+        return self.block
+
+    def timestamp(self):
+        now = int(time.time())
+        if self.stamp[0] != now:
+            self.stamp = (now, time.strftime("%Y/%m/%d %H:%M:%S", time.gmtime(now)))
+        return self.stamp[1]
+
+    def enrich(self, js):
+        # GeoHash conversion
+        if 'geo_lat' in js and 'geo_long' in js:
+            try:
+                js['geo_location'] = {
+                    "lat": float(js['geo_lat']),
+                    "lon": float(js['geo_long'])
+                }
+            except (TypeError, ValueError):
+                pass
+        js.update(self.static())
+        js['@timestamp'] = self.timestamp()
+        # Rogue string sometimes, we don't want that!
+        if 'bytes' in js:
+            try:
+                js['bytes'] = int(js['bytes'])
+            except (TypeError, ValueError):
+                js['bytes'] = 0
+        if 'request' in js and not 'url' in js:
+            match = self.re_url.match(js['request'])
+            if match:
+                js['url'] = match.group(2)
+        return js
+
+enricher = Enricher()
+
+
+def enrich_legacy(docs):
+    """The old per-document enrichment. Kept for --benchmark-enrich."""
+    for entry in docs:
+        js = entry
+        # GeoHash conversion
+        if 'geo_lat' in js and 'geo_long' in js:
+            try:
+                js['geo_location'] = {
+                    "lat": float(js['geo_lat']),
+                    "lon": float(js['geo_long'])
+                }
+            except:
+                pass
+        js['@version'] = 2
+        js['@timestamp'] = time.strftime("%Y/%m/%d %H:%M:%S", time.gmtime())
+        js['host'] = hostname
+        js['@node'] = hostname
+        js['@fingerprint'] = FINGERPRINT
+        js['@fingerprint_sha'] = FINGERPRINT_SHA
+#             js['@rsa_key_mtime'] = RSA_KEY_MTIME
+        # Rogue string sometimes, we don't want that!
+        if 'bytes' in js:
+            try:
+                js['bytes'] = int(js['bytes'])
+            except:
+                js['bytes'] = 0
+        if mytags:
+            js['@tags'] = mytags
+        if 'request' in js and not 'url' in js:
+            match = re.match(r"(GET|POST)\s+(.+)\s+HTTP/.+", js['request'])
+            if match:
+                js['url'] = match.group(2)
+        if 'bytes' in js and isinstance(js['bytes'], basestring) and js['bytes'].isdigit():
+            js['bytes_int'] = int(js['bytes'])
+
+
+class IndexManager:
+    """Makes sure the daily loggy-YYYY.MM.DD indices exist with our mappings.
+
+    The mappings are built once from the [RawFields] section. Indices we
+    know exist are remembered (and, with a cache file, across restarts), so
+    shipping threads only take the lock and talk to ElasticSearch the first
+    time they see a new day. precreate() sets up tomorrow's index an hour
+    ahead of the rollover, so midnight doesn't stall every worker at once.
+    It does so on a thread of its own, so the main loop can call it as
+    often as it likes without ever waiting on ElasticSearch."""
+
+    def __init__(self, xes, cache_path = None):
         self.xes = xes
+        self.cache_path = cache_path
+        self.lock = Lock()
+        self.known = set()
+        self.next_precreate = 0
+        self.precreating = None
+        self.precreate_failures = 0
+        if cache_path:
+            try:
+                with open(cache_path, "r") as f:
+                    self.known = set(json.load(f))
+            except (IOError, ValueError):
+                pass
+        self.mappings = {}
+        for entry in config.options('RawFields'):
+            js = {
+                "_all" : {"enabled" : True},
+                "properties": {
+                    "@timestamp" : { "store": True, "type" : "date", "format": "yyyy/MM/dd HH:mm:ss"},
+                    "@node" : { "store": True, "type" : "string", "index": "not_analyzed"},
+                    "status" : { "store": True, "type" : "long"},
+                    "date" : { "store": True, "type" : "string", "index": "not_analyzed"},
+                    "geo_location" : { "type": "geo_point", "geohash": True }
+                }
+            }
+            for field in config.get('RawFields', entry).split(","):
+                x = field.strip()
+                js['properties'][x] = {"store": True, "type": "string", "index": "not_analyzed", "fields": { "keyword": { "type": "keyword" }}}
+            self.mappings[entry] = js
 
-    def run(self):
-        global gotindex, config, json_pending
-        random.seed(time.time())
-        #print("Pushing %u json objects" % len(json_pending))
-        iname = time.strftime("loggy-%Y.%m.%d")
-        sys.stderr.flush()
-        if not iname in gotindex:
-            gotindex[iname] = True
+    def name(self, when = None):
+        return time.strftime("loggy-%Y.%m.%d", time.localtime(when))
+
+    def ensure(self, iname):
+        """Creates iname unless we already know it exists. Thread safe."""
+        if iname in self.known:
+            return
+        with self.lock:
+            if iname in self.known:
+                return # another thread beat us to it
             if not self.xes.indices.exists(index=iname):
-                mappings = {}
-                for entry in config.options('RawFields'):
-                    js = {
-                        "_all" : {"enabled" : True},
-                        "properties": {
-                            "@timestamp" : { "store": True, "type" : "date", "format": "yyyy/MM/dd HH:mm:ss"},
-                            "@node" : { "store": True, "type" : "string", "index": "not_analyzed"},
-                            "status" : { "store": True, "type" : "long"},
-                            "date" : { "store": True, "type" : "string", "index": "not_analyzed"},
-                            "geo_location" : { "type": "geo_point", "geohash": True }
-                        }
-                    }
-                    for field in config.get('RawFields', entry).split(","):
-                        x = field.strip()
-                        js['properties'][x] = {"store": True, "type": "string", "index": "not_analyzed", "fields": { "keyword": { "type": "keyword" }}}
-                    mappings[entry] = js
-                    
                 res = self.xes.indices.create(index = iname, ignore=400, body = {
                         "settings" : {
                             "index.mapping.ignore_malformed": True,
                             "number_of_shards": 2,
                             "number_of_replicas": 0
                         },
-                        "mappings" : mappings
+                        "mappings" : self.mappings
                     }
                 )
                 if not 'loggy-indices' in json_pending:
@@ -362,57 +559,559 @@ class NodeThread(Thread):
                     'logtype': 'loggy-indices',
                     '@timestamp': time.strftime("%Y/%m/%d %H:%M:%S", time.gmtime()),
                     'res': res,
-                    'mappings': mappings
+                    'mappings': self.mappings
                     })
-            
+            self.known.add(iname)
+            self.save()
+
+    def save(self):
+        if not self.cache_path:
+            return
+        # Only today and tomorrow are worth remembering
+        keep = [i for i in self.known if i in (self.name(), self.name(time.time() + 86400))]
+        try:
+            with open(self.cache_path, "w") as f:
+                json.dump(keep, f)
+        except IOError as err:
+            syslog.syslog(syslog.LOG_WARNING, "Could not save index cache: %s" % err)
+
+    def precreate(self, ahead = 3600, every = 60):
+        """Creates tomorrow's index once we're within an hour of midnight.
+        Checks at most once every `every` seconds, backing off when
+        ElasticSearch isn't having it, and never blocks the caller."""
+        now = time.time()
+        if now < self.next_precreate or (self.precreating and self.precreating.is_alive()):
+            return
+        tomorrow = self.name(now + ahead)
+        if tomorrow in self.known:
+            self.next_precreate = now + every
+            return
+        self.precreating = Thread(target = self.create_ahead, args = (tomorrow, every))
+        self.precreating.daemon = True
+        self.precreating.start()
+
+    def create_ahead(self, iname, every):
+        try:
+            self.ensure(iname)
+            self.precreate_failures = 0
+        except Exception as err:
+            self.precreate_failures += 1
+            syslog.syslog(syslog.LOG_WARNING, "Could not create index %s: %s" % (iname, err))
+        self.next_precreate = time.time() + min(every * 2 ** self.precreate_failures, 900)
+
+
+class NodeThread(Thread):
+    """A shipping worker: pulls batches off the shipper queue and bulk
+    pushes them to ElasticSearch, one at a time."""
+    def assign(self, shipper, xes):
+        self.shipper = shipper
+        self.xes = xes
+        self.daemon = True
+
+    def run(self):
+        while True:
+            logtype, docs, bid, iname = self.shipper.queue.get()
+            start = time.time()
+            try:
+                self.push(docs, logtype, bid, iname)
+                metrics.bulk(logtype, len(docs), time.time() - start, True)
+                self.shipper.count('shipped', len(docs))
+                self.shipper.done(bid)
+            except Exception as err:
+                metrics.bulk(logtype, len(docs), time.time() - start, False)
+                syslog.syslog(syslog.LOG_WARNING, "Could not ship %u %s documents: %s" % (len(docs), logtype, err))
+                self.shipper.count('failed', len(docs))
+                self.shipper.failed(logtype, docs, bid, err)
+            self.shipper.queue.task_done()
+
+    def push(self, docs, logtype, bid = None, iname = None):
+        global config, json_pending
+        random.seed(time.time())
+        #print("Pushing %u json objects" % len(json_pending))
+        # Batches keep the index they were submitted for, so a replay
+        # after midnight overwrites rather than duplicates them
+        iname = iname or self.shipper.indices.name()
+        sys.stderr.flush()
+        self.shipper.indices.ensure(iname)
+
         js_arr = []
-        for entry in self.json:
-            js = entry
-            # GeoHash conversion
-            if 'geo_lat' in js and 'geo_long' in js:
-                try:
-                    js['geo_location'] = {
-                        "lat": float(js['geo_lat']),
-                        "lon": float(js['geo_long'])
-                    }
-                except:
-                    pass
-            js['@version'] = 2
-            js['@timestamp'] = time.strftime("%Y/%m/%d %H:%M:%S", time.gmtime())
-            js['host'] = hostname
-            js['@node'] = hostname
-            js['@fingerprint'] = FINGERPRINT
-            js['@fingerprint_sha'] = FINGERPRINT_SHA
-#             js['@rsa_key_mtime'] = RSA_KEY_MTIME
-            # Rogue string sometimes, we don't want that!
-            if 'bytes' in js:
-                try:
-                    js['bytes'] = int(js['bytes'])
-                except:
-                    js['bytes'] = 0
-            if mytags:
-                js['@tags'] = mytags
-            if 'request' in js and not 'url' in js:
-                match = re.match(r"(GET|POST)\s+(.+)\s+HTTP/.+", js['request'])
-                if match:
-                    js['url'] = match.group(2)
-            if 'bytes' in js and isinstance(js['bytes'], basestring) and js['bytes'].isdigit():
-                js['bytes_int'] = int(js['bytes'])
-            
-            js_arr.append({
+        for n, js in enumerate(docs):
+            enricher.enrich(js)
+            op = {
                 '_op_type': 'index',
                 '_index': iname,
-                '_type': self.logtype,
+                '_type': logtype,
                 'doc': js,
                 '_source': js
-            })
+            }
+            # Spooled batches get stable IDs, so replaying one is idempotent
+            if bid:
+                op['_id'] = "%s-%u" % (bid, n)
+            js_arr.append(op)
             
         if len(js_arr) > 0:
             #es.bulk(index=iname, doc_type=self.logtype, body = js_arr )
             helpers.bulk(self.xes, js_arr)
         #except Exception as err:
             #print(err)
-            
+
+
+class Spool:
+    """Append-only on-disk spool of bulk batches that have not been shipped
+    yet. Every batch is written here before it is queued, and acknowledged
+    once ElasticSearch has taken it, so batches in flight (or waiting for a
+    slow cluster) survive a restart and are replayed on startup.
+
+    The spool is split into numbered segments (batches.N.json plus an
+    acks.N list); a segment is deleted once all its batches are acked."""
+
+    def __init__(self, path, segment_size = 16*1024*1024):
+        self.path = path
+        self.segment_size = segment_size
+        self.lock = Lock()
+        self.segments = {} # segment number -> set of unacked batch IDs
+        self.where = {}    # batch ID -> segment number
+        for name in os.listdir(path):
+            m = re.match(r"^batches\.(\d+)\.json$", name)
+            if m:
+                self.segments[int(m.group(1))] = set()
+        for seg in sorted(self.segments):
+            for batch in self.read(seg):
+                self.segments[seg].add(batch['id'])
+                self.where[batch['id']] = seg
+        self.current = max(self.segments.keys() or [0]) + 1
+        self.prune()
+        self.segments[self.current] = set()
+        self.size = 0
+
+    def filenames(self, seg):
+        return (os.path.join(self.path, "batches.%u.json" % seg),
+                os.path.join(self.path, "acks.%u" % seg))
+
+    def append(self, logtype, docs, iname = None, encoded = None):
+        """Write a batch (and the index it's bound for) to the spool,
+        returns its id. encoded is the docs already JSON encoded, if the
+        caller has that to hand."""
+        bid = uuid.uuid4().hex
+        if encoded is None:
+            encoded = [json.dumps(doc) for doc in docs]
+        line = '{"id": "%s", "logtype": %s, "index": %s, "docs": [%s]}\n' % (
+            bid, json.dumps(logtype), json.dumps(iname), ", ".join(encoded))
+        with self.lock:
+            with open(self.filenames(self.current)[0], "a") as f:
+                f.write(line)
+            self.segments[self.current].add(bid)
+            self.where[bid] = self.current
+            self.size += len(line)
+            if self.size > self.segment_size:
+                self.current += 1
+                self.segments[self.current] = set()
+                self.size = 0
+                self.prune()
+        return bid
+
+    def ack(self, bid):
+        """Mark a batch as done with (shipped or deliberately dropped)"""
+        with self.lock:
+            seg = self.where.pop(bid, None)
+            if seg is None:
+                return
+            self.segments[seg].discard(bid)
+            if not self.segments[seg] and seg != self.current:
+                self.remove(seg)
+            else:
+                with open(self.filenames(seg)[1], "a") as f:
+                    f.write(bid + "\n")
+
+    def remove(self, seg):
+        for path in self.filenames(seg):
+            if os.path.exists(path):
+                os.unlink(path)
+        del self.segments[seg]
+
+    def prune(self):
+        """Delete every segment but the current one that has nothing left
+        unacknowledged, e.g. one that was all acked while it was current, or
+        that was left behind by the last run. Call with the lock held."""
+        for seg in [seg for seg, ids in self.segments.items() if not ids and seg != self.current]:
+            self.remove(seg)
+
+    def read(self, seg):
+        """Yields the batches in a segment that have not been acknowledged"""
+        batchfile, ackfile = self.filenames(seg)
+        acked = set()
+        if os.path.exists(ackfile):
+            with open(ackfile, "r") as f:
+                acked = set(l.strip() for l in f)
+        if os.path.exists(batchfile):
+            with open(batchfile, "r") as f:
+                for line in f:
+                    try:
+                        batch = json.loads(line)
+                    except ValueError:
+                        continue # torn write from a crash
+                    if batch['id'] not in acked:
+                        yield batch
+
+    def pending(self):
+        """Yields all unacknowledged batches, oldest first"""
+        with self.lock:
+            segs = sorted(seg for seg, ids in self.segments.items() if ids)
+        for seg in segs:
+            for batch in self.read(seg):
+                yield batch
+
+    def compact(self):
+        """Drop the current segment too if everything in it has been acked"""
+        with self.lock:
+            if not self.segments[self.current] and self.size:
+                for path in self.filenames(self.current):
+                    if os.path.exists(path):
+                        os.unlink(path)
+                self.size = 0
+
+
+def retryable(err):
+    """Whether a failed bulk push is worth trying again. ElasticSearch being
+    down, slow or busy (429) is; it rejecting the documents (mapping errors,
+    malformed requests and other 4xx) is not, they'll fail the same way
+    every time."""
+    if isinstance(err, helpers.BulkIndexError):
+        errors = err.args[1] if len(err.args) > 1 else []
+        statuses = [list(item.values())[0].get('status') for item in errors if item]
+        return not statuses or any(status in (429, None) or status >= 500 for status in statuses)
+    if isinstance(err, TransportError) and isinstance(err.status_code, int):
+        return err.status_code == 429 or err.status_code >= 500
+    return True
+
+
+class Shipper:
+    """Bounded shipping pipeline: a fixed pool of NodeThreads fed by a
+    bounded queue of bulk batches. When ElasticSearch can't keep up and the
+    queue fills, batches are either dropped or spilled to the spool (see the
+    [Shipping] section of loggy.cfg), so a slow cluster costs us documents
+    rather than threads and memory. Batches ElasticSearch rejects outright,
+    or that have failed max_retries times, go to the dead_letter file
+    instead of being retried forever."""
+
+    def __init__(self, xes, workers = 4, queue_size = 64, batch_size = 500,
+                 batch_bytes = 5*1024*1024, policy = 'drop', spool_path = None,
+                 index_cache = None, max_retries = 10, dead_letter = None):
+        self.queue = Queue.Queue(queue_size)
+        self.indices = IndexManager(xes, index_cache)
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.policy = policy
+        self.spool = Spool(spool_path) if spool_path else None
+        self.inflight = set()
+        self.last_unspill = 0 # replay whatever the last run left behind
+        self.lock = Lock()
+        self.max_retries = max_retries
+        self.dead_letter = dead_letter or (os.path.join(spool_path, "dead.json") if spool_path else None)
+        self.attempts = {} # batch ID -> failed pushes so far
+        self.counters = {
+            'queued': 0,
+            'shipped': 0,
+            'dropped': 0,
+            'spilled': 0,
+            'requeued': 0,
+            'failed': 0,
+            'dead': 0,
+        }
+        for i in range(workers):
+            t = NodeThread()
+            t.assign(self, xes)
+            t.start()
+
+    def count(self, counter, n):
+        with self.lock:
+            self.counters[counter] += n
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
+
+    def batches(self, docs):
+        """Split docs into batches bounded by both count and (JSON) size.
+        Yields (batch, encoded) pairs, encoded being the batch's docs as
+        JSON, so the spool can write them without encoding them again."""
+        batch = []
+        encoded = []
+        size = 0
+        for doc in docs:
+            js = json.dumps(doc)
+            if batch and (len(batch) >= self.batch_size or size + len(js) > self.batch_bytes):
+                yield batch, encoded
+                batch = []
+                encoded = []
+                size = 0
+            batch.append(doc)
+            encoded.append(js)
+            size += len(js)
+        if batch:
+            yield batch, encoded
+
+    def submit(self, logtype, docs):
+        """Queue docs for shipping. Never blocks the caller."""
+        iname = self.indices.name()
+        for batch, encoded in self.batches(docs):
+            bid = self.spool.append(logtype, batch, iname, encoded) if self.spool else None
+            self.enqueue(logtype, batch, bid, iname)
+
+    def enqueue(self, logtype, batch, bid, iname = None):
+        with self.lock:
+            self.inflight.add(bid)
+        try:
+            self.queue.put_nowait((logtype, batch, bid, iname))
+            self.count('queued', len(batch))
+        except Queue.Full:
+            self.overflow(logtype, batch, bid)
+
+    def done(self, bid):
+        """A batch has been shipped"""
+        with self.lock:
+            self.inflight.discard(bid)
+            self.attempts.pop(bid, None)
+        if self.spool and bid:
+            self.spool.ack(bid)
+
+    def overflow(self, logtype, batch, bid):
+        """Deal with a batch we could not queue or ship, as per policy"""
+        with self.lock:
+            self.inflight.discard(bid)
+        if self.policy == 'spill' and self.spool and bid:
+            # It's already on disk, just leave it unacknowledged there
+            self.count('spilled', len(batch))
+            return
+        if self.spool and bid:
+            self.spool.ack(bid)
+        self.count('dropped', len(batch))
+
+    def failed(self, logtype, batch, bid, err):
+        """A batch could not be shipped: try again later (as per policy)
+        unless it's never going to work"""
+        if bid is None:
+            tries = 1 # not spooled, so it can't be retried: overflow() drops it
+        else:
+            with self.lock:
+                tries = self.attempts[bid] = self.attempts.get(bid, 0) + 1
+        if not retryable(err):
+            self.bury(logtype, batch, bid, "rejected: %s" % err, tries)
+        elif tries >= self.max_retries:
+            self.bury(logtype, batch, bid, "gave up after %u tries: %s" % (tries, err), tries)
+        else:
+            self.overflow(logtype, batch, bid)
+
+    def bury(self, logtype, batch, bid, reason, tries):
+        """Move a batch we'll never ship to the dead letter file"""
+        with self.lock:
+            self.inflight.discard(bid)
+            self.attempts.pop(bid, None)
+        syslog.syslog(syslog.LOG_WARNING, "Giving up on %u %s documents, %s" % (len(batch), logtype, reason))
+        if self.dead_letter:
+            try:
+                with open(self.dead_letter, "a") as f:
+                    f.write(json.dumps({'id': bid, 'logtype': logtype, 'docs': batch, 'reason': reason,
+                                        'tries': tries, 'time': time.time()}) + "\n")
+            except IOError as err:
+                syslog.syslog(syslog.LOG_WARNING, "Could not write to dead letter file %s: %s" % (self.dead_letter, err))
+        if self.spool and bid:
+            self.spool.ack(bid)
+        self.count('dead', len(batch))
+
+    def unspill(self, interval = 60):
+        """Requeue spooled batches that aren't in flight once the queue has
+        drained. Only tried every so often, so a down cluster isn't retried
+        in a tight loop."""
+        if not self.spool or time.time() < (self.last_unspill + interval):
+            return
+        if not self.queue.empty():
+            return
+        self.last_unspill = time.time()
+        for batch in self.spool.pending():
+            with self.lock:
+                if batch['id'] in self.inflight:
+                    continue
+            if self.queue.full():
+                break
+            self.count('requeued', len(batch['docs']))
+            self.enqueue(batch['logtype'], batch['docs'], batch['id'], batch.get('index'))
+        self.spool.compact()
+
+
+def make_shipper(config, xes):
+    """Sets up the shipping pipeline from the [Shipping] config section"""
+    opts = {}
+    if config.has_section('Shipping'):
+        for key in ('workers', 'queue_size', 'batch_size', 'batch_bytes', 'max_retries'):
+            if config.has_option('Shipping', key):
+                opts[key] = config.getint('Shipping', key)
+        for key in ('policy', 'spool_path', 'index_cache', 'dead_letter'):
+            if config.has_option('Shipping', key):
+                opts[key] = config.get('Shipping', key)
+    return Shipper(xes, **opts)
+
+
+class Checkpoints:
+    """Remembers how far into each file (by path and inode) we have read and
+    handed off to the shipper, so a restart resumes where we left off
+    instead of at the end of every file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.offsets = {}
+        try:
+            with open(path, "r") as f:
+                self.offsets = json.load(f)
+        except (IOError, ValueError):
+            pass
+
+    def seek(self, path, fh, inode):
+        """Position a freshly opened file handle"""
+        entry = self.offsets.get(path)
+        if entry and entry['inode'] == inode and entry['offset'] <= os.fstat(fh.fileno()).st_size:
+            fh.seek(entry['offset'])
+        elif entry:
+            # Rotated since our last checkpoint, or truncated in place (copytruncate),
+            # so it's all new to us
+            fh.seek(0)
+        else:
+            fh.seek(0,2)
+
+    def save(self, handles, inodes_path):
+        """Record the current offset of every open file, atomically"""
+        for path, fh in handles.items():
+            try:
+                self.offsets[path] = {'inode': inodes_path[path], 'offset': fh.tell()}
+            except (KeyError, ValueError, IOError):
+                pass
+        for path in list(self.offsets.keys()):
+            if not os.path.exists(path):
+                del self.offsets[path]
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.offsets, f)
+        os.rename(tmp, self.path)
+
+
+class Metrics:
+    """Counters for the local stats endpoint: what we read and matched per
+    file, what we shipped per log type (with a bulk latency histogram), and
+    how far behind EOF each file and the shipping queue are."""
+
+    buckets = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+    def __init__(self):
+        self.lock = Lock()
+        self.started = time.time()
+        self.files = {}
+        self.logtypes = {}
+        self.shipper = None
+        self.coalescer = None
+
+    def logtype(self, logtype):
+        if logtype not in self.logtypes:
+            self.logtypes[logtype] = {
+                'matched': 0,
+                'bulk_requests': 0,
+                'bulk_errors': 0,
+                'docs_shipped': 0,
+                'bulk_latency': [0] * (len(self.buckets) + 1),
+            }
+        return self.logtypes[logtype]
+
+    def parsed(self, path, read, matched, spent):
+        """Records one parseLine() call; matched is a dict of logtype->lines"""
+        with self.lock:
+            if path not in self.files:
+                self.files[path] = {'lines_read': 0, 'matched': 0, 'unmatched': 0, 'parse_time': 0.0}
+            f = self.files[path]
+            n = sum(matched.values())
+            f['lines_read'] += read
+            f['matched'] += n
+            f['unmatched'] += read - n
+            f['parse_time'] += spent
+            for logtype, count in matched.items():
+                self.logtype(logtype)['matched'] += count
+
+    def bulk(self, logtype, docs, spent, ok):
+        """Records one bulk request to ElasticSearch"""
+        with self.lock:
+            lt = self.logtype(logtype)
+            lt['bulk_requests'] += 1
+            if ok:
+                lt['docs_shipped'] += docs
+            else:
+                lt['bulk_errors'] += 1
+            i = 0
+            while i < len(self.buckets) and spent > self.buckets[i]:
+                i += 1
+            lt['bulk_latency'][i] += 1
+
+    def snapshot(self):
+        with self.lock:
+            files = dict((path, dict(f)) for path, f in self.files.items())
+            logtypes = {}
+            for logtype, lt in self.logtypes.items():
+                logtypes[logtype] = dict(lt)
+                # Cumulative, as in "requests that took <= N seconds"
+                total = 0
+                histogram = {}
+                for le, count in zip(["le_%s" % b for b in self.buckets] + ['le_inf'], lt['bulk_latency']):
+                    total += count
+                    histogram[le] = total
+                logtypes[logtype]['bulk_latency'] = histogram
+        for path, fh in list(filehandles.items()):
+            try:
+                behind = os.fstat(fh.fileno()).st_size - fh.tell()
+            except (OSError, IOError, ValueError):
+                continue
+            files.setdefault(path, {})['bytes_behind'] = behind
+        js = {
+            'uptime': int(time.time() - self.started),
+            'files': files,
+            'logtypes': logtypes,
+        }
+        if self.shipper:
+            js['shipping'] = self.shipper.stats()
+            js['shipping']['queue_depth'] = self.shipper.queue.qsize()
+            js['shipping']['queue_size'] = self.shipper.queue.maxsize
+        if self.coalescer:
+            js['inotify'] = self.coalescer.stats()
+        for logtype, pending in list(json_pending.items()):
+            if pending:
+                logtypes.setdefault(logtype, {})['pending'] = len(pending)
+        return js
+
+metrics = Metrics()
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves the metrics snapshot as JSON on any GET"""
+    def do_GET(self):
+        body = json.dumps(metrics.snapshot(), indent = 2)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # no access logging to stderr
+
+
+def start_metrics(config):
+    """Starts the stats endpoint if [Metrics] has a port configured"""
+    if not config.has_option('Metrics', 'port'):
+        return
+    host = config.get('Metrics', 'host') if config.has_option('Metrics', 'host') else '127.0.0.1'
+    port = config.getint('Metrics', 'port')
+    server = BaseHTTPServer.HTTPServer((host, port), MetricsHandler)
+    t = Thread(target = server.serve_forever)
+    t.daemon = True
+    t.start()
+    syslog.syslog(syslog.LOG_INFO, "Serving metrics on http://%s:%u/" % (host, port))
+
 
 def connect_es(config):
     esa = []
@@ -439,10 +1138,52 @@ def connect_es(config):
     return esx
 
 
-def parseLine(path, data):
+class Tail:
+    """Tails a log file in large binary chunks. Complete lines are yielded
+    as they are found, and a trailing partial line is kept until the rest of
+    it shows up in a later read. tell() is the offset just past the last
+    complete line handed out, which is what checkpoints should record."""
+
+    def __init__(self, path, chunk = 1024*1024):
+        self.fh = io.open(path, "rb", buffering = 0)
+        self.chunk = chunk
+        self.carry = ""
+
+    def fileno(self):
+        return self.fh.fileno()
+
+    def seek(self, offset, whence = 0):
+        self.carry = ""
+        return self.fh.seek(offset, whence)
+
+    def tell(self):
+        return self.fh.tell() - len(self.carry)
+
+    def close(self):
+        self.fh.close()
+
+    def lines(self):
+        """Yields every complete line written since the last call"""
+        while True:
+            data = self.fh.read(self.chunk)
+            if not data:
+                break
+            if self.carry:
+                data = self.carry + data
+            parts = data.split("\n")
+            self.carry = parts.pop()
+            for line in parts:
+                yield line
+
+
+def parseLine(path, lines):
     global json_pending, config
-    for line in (l.rstrip() for l in data.split("\n")):
-        m = re.match(r"^<%JSON:([^>%]+)%>\s*(.+)", line)
+    start = time.time()
+    read = 0
+    matched = defaultdict(int)
+    for line in (l.rstrip() for l in lines):
+        read += 1
+        m = re_json_line.match(line) if line.startswith(JSON_PREFIX) else None
         if m:
             try:
                 # Try normally
@@ -459,19 +1200,101 @@ def parseLine(path, data):
                     last_push[js['logtype']] = time.time()
                     print("got our first valid json as " + js['logtype'] + "!")
                 json_pending[js['logtype']].append(js)
+                matched[js['logtype']] += 1
             except:
                 pass
         else:
-            for r in regexes:
-                match = regexes[r].match(line)
-                if match:
-                    if not r == 'apache_access':
-                        print("Found a " + r + " match")
-                    js = tuples[r]( filepath=path, logtype=r, timestamp = time.time() , **match.groupdict())
-                    json_pending[r].append(js._asdict())
-                    if not r == 'apache_access':
-                        print("Appended a " + r + " match")
-                    break
+            r, fields = classifier.classify(path, line)
+            if r:
+                if not r == 'apache_access':
+                    print("Found a " + r + " match")
+                js = tuples[r]( filepath=path, logtype=r, timestamp = time.time() , **fields)
+                json_pending[r].append(js._asdict())
+                matched[r] += 1
+                if not r == 'apache_access':
+                    print("Appended a " + r + " match")
+    metrics.parsed(path, read, matched, time.time() - start)
+
+
+def classify_legacy(path, line):
+    """The old classifier: every regex in turn. Kept for --benchmark."""
+    if re.match(r"^<%JSON:([^>%]+)%>\s*(.+)", line):
+        return 'json'
+    for r in logtype_order:
+        match = regexes[r].match(line)
+        if match:
+            match.groupdict()
+            return r
+    return None
+
+def classify_combined(path, line):
+    if line.startswith(JSON_PREFIX) and re_json_line.match(line):
+        return 'json'
+    return classifier.classify(path, line)[0]
+
+def benchmark(files):
+    """Replays recorded log files through both classifiers, prints lines/sec"""
+    corpus = []
+    for path in files:
+        with open(path, "r") as f:
+            corpus += [(path, l.rstrip()) for l in f]
+    print("Loaded %u lines from %u file(s)" % (len(corpus), len(files)))
+    results = {}
+    for name, fn in (('legacy', classify_legacy), ('combined', classify_combined)):
+        counts = defaultdict(int)
+        start = time.time()
+        for path, line in corpus:
+            counts[fn(path, line)] += 1
+        spent = max(time.time() - start, 0.000001)
+        results[name] = counts
+        print("%-9s %10.0f lines/sec (%.2fs)" % (name, len(corpus) / spent, spent))
+    if results['legacy'] != results['combined']:
+        print("WARNING: classifiers disagree: %s vs %s" % (dict(results['legacy']), dict(results['combined'])))
+    else:
+        print("Classification: %s" % dict(results['combined']))
+
+def read_legacy(path):
+    """The old way of reading a burst: readline() + concatenation + split"""
+    data = ""
+    with open(path, "r") as f:
+        while True:
+            line = f.readline()
+            if not line:
+                break
+            data += line
+    return sum(1 for l in data.split("\n"))
+
+def read_tail(path):
+    tail = Tail(path)
+    n = sum(1 for l in tail.lines())
+    tail.close()
+    return n
+
+def benchmark_tail(path):
+    """Reads a (large) log file in one burst with the old and new readers"""
+    size = os.path.getsize(path)
+    for name, fn in (('tail', read_tail), ('legacy', read_legacy)):
+        start = time.time()
+        n = fn(path)
+        spent = max(time.time() - start, 0.000001)
+        print("%-7s %8.1f MB/sec %10.0f lines/sec (%u lines, %.2fs)" % (name, size / spent / 1048576, n / spent, n, spent))
+
+def benchmark_enrich(batches = 200):
+    """Runs 500-doc batches of access log documents through both enrichers"""
+    sample = {
+        'client_ip': '192.0.2.1', 'identity': '-', 'user': '-',
+        'time': '18/Oct/2018:12:00:00 +0000', 'request': 'GET /index.html HTTP/1.1',
+        'status': '200', 'bytes': '5120', 'referer': '-', 'user_agent': 'Mozilla/5.0',
+        'geo_lat': '52.52', 'geo_long': '13.40',
+        'filepath': '/var/log/apache2/access.log', 'logtype': 'apache_access', 'timestamp': time.time()
+    }
+    for name, fn in (('legacy', enrich_legacy), ('enricher', lambda docs: [enricher.enrich(js) for js in docs])):
+        work = [[dict(sample) for i in range(500)] for b in range(batches)]
+        start = time.time()
+        for docs in work:
+            fn(docs)
+        spent = max(time.time() - start, 0.000001)
+        print("%-9s %10.0f docs/sec (%u x 500 docs, %.2fs)" % (name, batches * 500 / spent, batches, spent))
 
 if osname == "freebsd":
     class BSDHandler(PatternMatchingEventHandler):
@@ -494,9 +1317,12 @@ if osname == "freebsd":
                     inode = idata.st_ino
                     if not inode in inodes:
                         print("Opening: " + path)
-                        filehandles[path] = open(path, "r")
+                        filehandles[path] = Tail(path)
                         print("Started watching %s (%u)" % (path, inode))
-                        filehandles[path].seek(0,2)
+                        if checkpoints:
+                            checkpoints.seek(path, filehandles[path], inode)
+                        else:
+                            filehandles[path].seek(0,2)
                         inodes[inode] = path
                         inodes_path[path] = inode
                         print(path, filehandles[path])
@@ -504,20 +1330,9 @@ if osname == "freebsd":
                     print(err)
             elif event.event_type == 'modified' and path in filehandles:
                 print(path + " was modified")
-                rd = 0
-                data = ""
                 #print("Change in " + path)
                 try:
-                    while True:
-                        line = filehandles[path].readline()
-                        if not line:
-                            #filehandles[path].seek(0,2)
-                            break
-                        else:
-                            rd += len(line)
-                            data += line
-                    #print("Read %u bytes from %s" % (rd, path))
-                    parseLine(path, data)
+                    parseLine(path, filehandles[path].lines())
                 except Exception as err:
                     try:
                         print("Could not utilize " + path + ", closing.." + err)
@@ -550,10 +1365,80 @@ if osname == "freebsd":
         def on_moved(self, event):
             self.process(event)
 
+class Coalescer:
+    """Merges a batch of inotify events per path before they are dispatched.
+
+    Events keep the order in which their path was first seen. A move or
+    delete supersedes whatever came before it for that path, and repeats
+    of an event already pending for a path (typically a stream of
+    IN_MODIFY) are dropped, since one read picks up everything written so
+    far anyway. Directory events are handled by the AutoWatcher itself and
+    are not dispatched at all."""
+
+    def __init__(self):
+        self.received = 0
+        self.dispatched = 0
+
+    def coalesce(self, events):
+        order = []
+        pending = {}
+        for evt in events:
+            self.received += 1
+            mask = evt.mask
+            if mask & inotify.IN_ISDIR:
+                continue
+            path = evt.fullpath
+            if path not in pending:
+                order.append(path)
+                pending[path] = []
+            if mask & (inotify.IN_MOVED_FROM | inotify.IN_DELETE):
+                pending[path] = [mask]
+            elif mask & inotify.IN_MODIFY and any(m & inotify.IN_MODIFY for m in pending[path]):
+                continue
+            elif mask not in pending[path]:
+                pending[path].append(mask)
+        merged = [(path, mask) for path in order for mask in pending[path]]
+        self.dispatched += len(merged)
+        return merged
+
+    def stats(self):
+        return {'received': self.received, 'dispatched': self.dispatched}
+
+
+def flush_pending(shipper, fp, path_inodes = None):
+    """Once any json_pending bucket is due (15 seconds old or a full batch),
+    hand every bucket to the shipper and checkpoint our file offsets. Flushing
+    them all at once means everything before a checkpoint is in the spool."""
+    now = time.time()
+    due = False
+    for x in list(json_pending.keys()):
+        if not x in last_push:
+            last_push[x] = now
+        if json_pending[x] and ((now > (last_push[x] + 15)) or len(json_pending[x]) >= shipper.batch_size):
+            due = True
+    if not due:
+        return
+    for x in list(json_pending.keys()):
+        if json_pending[x]:
+            if not x in fp:
+                fp[x] = True
+                syslog.syslog(syslog.LOG_INFO, "First push for " + x + "!")
+            shipper.submit(x, json_pending[x])
+            json_pending[x] = []
+        last_push[x] = now
+    if checkpoints:
+        try:
+            checkpoints.save(filehandles, path_inodes if path_inodes is not None else inodes_path)
+        except Exception as err:
+            syslog.syslog(syslog.LOG_WARNING, "Could not save checkpoints: %s" % err)
+
+
 class Loggy(Thread):
     def run(self):
-        global timeout, w, tuples, regexes, json_pending, last_push, config
+        global timeout, w, tuples, regexes, json_pending, last_push, config, checkpoints
         fp = {}
+        if config.has_option('Shipping', 'checkpoint_path'):
+            checkpoints = Checkpoints(config.get('Shipping', 'checkpoint_path'))
         if osname == "linux":
             w = watcher.AutoWatcher()
             for path in config.get('Analyzer','paths').split(","):
@@ -577,36 +1462,34 @@ class Loggy(Thread):
             inodes = {}
             inodes_path = {}
             xes = connect_es(config)
+            shipper = make_shipper(config, xes)
+            coalescer = Coalescer()
+            metrics.shipper = shipper
+            metrics.coalescer = coalescer
+            start_metrics(config)
+            last_stats = time.time()
             while True:
                 events = poll.poll(timeout)
                 nread = 0
                 if threshold() or not events:
                     #print('reading,', threshold.readable(), 'bytes available')
-                    for evt in w.read(0):
-                        nread += 1
-            
-                        # The last thing to do to improve efficiency here would be
-                        # to coalesce similar events before passing them up to a
-                        # higher level.
-            
-                        # For example, it's overwhelmingly common to have a stream
-                        # of inotify events contain a creation, followed by
-                        # multiple modifications of the created file.
-            
-                        # Recognising this pattern (and others) and coalescing
-                        # these events into a single creation event would reduce
-                        # the number of trips into our app's presumably more
-                        # computationally expensive upper layers.
-                        masks = inotify.decode_mask(evt.mask)
+                    events = w.read(0)
+                    nread += len(events)
+                    # Coalesce the events per path before passing them up, so a
+                    # creation followed by many modifications costs one read.
+                    for path, mask in coalescer.coalesce(events):
+                        masks = inotify.decode_mask(mask)
                         #print(masks)
-                        path = evt.fullpath
-                        #print(repr(evt.fullpath), ' | '.join(masks))
+                        #print(repr(path), ' | '.join(masks))
                         try:
                             if not u'IN_ISDIR' in masks:
                                 
                                 if (u'IN_MOVED_FROM' in masks) and (path in filehandles):
                                     print("File moved, closing original handle")
                                     try:
+                                        # A coalesced move may have swallowed the
+                                        # last IN_MODIFY, so drain the file first.
+                                        parseLine(path, filehandles[path].lines())
                                         filehandles[path].close()
                                     except Exception as err:
                                         print(err)
@@ -620,9 +1503,12 @@ class Loggy(Thread):
                                         idata = os.stat(path)
                                         inode = idata.st_ino
                                         if not inode in inodes:
-                                            filehandles[path] = open(path, "r")
+                                            filehandles[path] = Tail(path)
                                             print("Started watching " + path)
-                                            filehandles[path].seek(0,2)
+                                            if checkpoints:
+                                                checkpoints.seek(path, filehandles[path], inode)
+                                            else:
+                                                filehandles[path].seek(0,2)
                                             inodes[inode] = path
                                             inodes_path[path] = inode
                                             
@@ -652,20 +1538,9 @@ class Loggy(Thread):
                                 # File contents modified?
                                 elif u'IN_MODIFY' in masks and path in filehandles:
                               #      print(path + " was modified")
-                                    rd = 0
-                                    data = ""
                                     #print("Change in " + path)
                                     try:
-                                        while True:
-                                            line = filehandles[path].readline()
-                                            if not line:
-                                                #filehandles[path].seek(0,2)
-                                                break
-                                            else:
-                                                rd += len(line)
-                                                data += line
-                                        #print("Read %u bytes from %s" % (rd, path))
-                                        parseLine(path, data)
+                                        parseLine(path, filehandles[path].lines())
                                     except Exception as err:
                                         try:
                                             print("Could not utilize " + path + ", closing.." + err)
@@ -682,6 +1557,7 @@ class Loggy(Thread):
                                     if path in filehandles:
                                         print("Closed " + path)
                                         try:
+                                            parseLine(path, filehandles[path].lines())
                                             filehandles[path].close()
                                         except Exception as err:
                                             print(err)
@@ -697,16 +1573,13 @@ class Loggy(Thread):
                             print(err)
                             
             
-                for x in json_pending:
-                    if (time.time() > (last_push[x] + 15)) or len(json_pending[x]) >= 500:
-                        if not x in fp:
-                            fp[x] = True
-                            print("First push for " + x + "!")
-                        t = NodeThread()
-                        t.assign(json_pending[x], x, xes)
-                        t.start()
-                        json_pending[x] = []
-                        last_push[x] = time.time()
+                flush_pending(shipper, fp, inodes_path)
+                shipper.unspill()
+                shipper.indices.precreate()
+                if time.time() > (last_stats + 300):
+                    last_stats = time.time()
+                    syslog.syslog(syslog.LOG_INFO, "Shipping stats: %s" % shipper.stats())
+                    syslog.syslog(syslog.LOG_INFO, "inotify stats: %s" % coalescer.stats())
                     
                 if nread:
                     #print('plugging back in')
@@ -719,6 +1592,10 @@ class Loggy(Thread):
         
         if osname == "freebsd":
             xes = connect_es(config)
+            shipper = make_shipper(config, xes)
+            metrics.shipper = shipper
+            start_metrics(config)
+            last_stats = time.time()
             observer = Observer()
             for path in paths:
                 observer.schedule(BSDHandler(), path, recursive=True)
@@ -726,18 +1603,12 @@ class Loggy(Thread):
             observer.start()
             try:
                 while True:
-                    for x in json_pending:
-                        if not x in last_push:
-                            last_push[x] = time.time()
-                        if len(json_pending[x]) > 0 and ((time.time() > (last_push[x] + 15)) or len(json_pending[x]) >= 500):
-                            if not x in fp:
-                                fp[x] = True
-                                syslog.syslog(syslog.LOG_INFO, "First push for " + x + "!")
-                            t = NodeThread()
-                            t.assign(json_pending[x], x, xes)
-                            t.start()
-                            json_pending[x] = []
-                            last_push[x] = time.time()
+                    flush_pending(shipper, fp)
+                    shipper.unspill()
+                    shipper.indices.precreate()
+                    if time.time() > (last_stats + 300):
+                        last_stats = time.time()
+                        syslog.syslog(syslog.LOG_INFO, "Shipping stats: %s" % shipper.stats())
                     time.sleep(0.5)
                     
             except KeyboardInterrupt:
@@ -758,6 +1629,12 @@ parser.add_argument('--daemonize', dest='daemon', action='store_true',
                    help='Run as a daemon')
 parser.add_argument('--stop', dest='kill', action='store_true',
                    help='Kill the currently running Loggy process')
+parser.add_argument('--benchmark', dest='benchmark', type=str, nargs='+',
+                   help='Benchmark line classification against recorded log files')
+parser.add_argument('--benchmark-tail', dest='benchmark_tail', type=str, nargs=1,
+                   help='Benchmark reading a large log file in one burst')
+parser.add_argument('--benchmark-enrich', dest='benchmark_enrich', action='store_true',
+                   help='Benchmark document enrichment on 500-doc batches')
 args = parser.parse_args()
 
 pidfile = "/var/run/loggy.pid"
@@ -789,6 +1666,12 @@ if args.kill:
     print("Stopping Loggy")
     daemon = MyDaemon(pidfile)
     daemon.stop()
+elif args.benchmark:
+    benchmark(args.benchmark)
+elif args.benchmark_tail:
+    benchmark_tail(args.benchmark_tail[0])
+elif args.benchmark_enrich:
+    benchmark_enrich()
 else:
     config.read("loggy.cfg")
     if os.path.exists('/etc/dd-agent/datadog.conf'):
@@ -4,16 +4,79 @@ import pyexcel_ods
 import collections
 import requests
 import re
-import sys
 import yaml
 import time
 from time import gmtime, strftime
 import os
+import json
+import argparse
+import threading
+import concurrent.futures
+import sqlite3
+import calendar
 
 # Exported files go here
 EXPORTS = '/var/www/snappy/exports'
 LDAPMAP = {}
 
+# Where a full run keeps track of finished domains, so a rerun can resume
+PROGRESS = '/var/www/snappy/webstats-progress.json'
+RESUME_WINDOW = 43200 # Resume runs started less than 12 hours ago
+
+# Daily per-domain totals, so each run only has to search the newest day(s)
+ROLLUP = '/var/www/snappy/webstats-rollup.db'
+ROLLUP_DAYS = 30
+# How many URIs/referrers to keep per day; the monthly top lists are made
+# from these, so they need to go a bit deeper than the 50/25 we show
+ROLLUP_URIS = 200
+ROLLUP_REFS = 100
+
+# Mirror download logs, and where we keep what we've read of them
+MIRRORS = ['http://www.eu.apache.org/dyn/stats/%s.log', 'http://www.us.apache.org/dyn/stats/%s.log']
+DOWNLOAD_CACHE = '/var/www/snappy/webstats-downloads'
+DOWNLOAD_WINDOW = 30*86400
+
+# Default timeouts (seconds) for the ES searches and the download stats
+SEARCH_TIMEOUT = 90
+BATCH_TIMEOUT = 600
+FETCH_TIMEOUT = 60
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Deadline(object):
+    """ Time budget for one domain. Every phase gets the smaller of its
+    usual timeout and whatever is left, and phases record how long they
+    took in timings. """
+    def __init__(self, seconds, timings):
+        self.end = time.time() + seconds if seconds else None
+        self.timings = timings
+
+    def timeout(self, default):
+        if self.end is None:
+            return default
+        left = self.end - time.time()
+        if left <= 0:
+            raise DeadlineExceeded("ran out of time")
+        return min(default, left)
+
+    def phase(self, name):
+        return Phase(self.timings, name)
+
+
+class Phase(object):
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *exc):
+        self.timings[self.name] = self.timings.get(self.name, 0) + time.time() - self.start
+
 # Elastic handler
 es = elasticsearch.Elasticsearch([
         {'host': 'localhost', 'port': 9200, 'url_prefix': '', 'use_ssl': False},
@@ -31,11 +94,8 @@ def dump_yaml(data, stream=None, Dumper=yaml.Dumper, **kwds):
 
         
 
-# Make a "book" (an ODS file)
-def makeBook(domain):
-        book = collections.OrderedDict()
-        
-        # This is the global search. We'll adjust as needed
+# The base search for a domain (or, with vhosts, a list of domains)
+def makeQuery(domain, vhosts = None):
         query = {
             "query": {
                 "bool": {
@@ -62,9 +122,30 @@ def makeBook(domain):
                 "excludes": []
             },
         }
-        
-        # Get most of the aggregations
-        query['aggs'] = {
+        if vhosts:
+            # Match vhost the way the single domain query does (it's analyzed,
+            # so case doesn't matter), not exactly on vhost.keyword
+            query["query"]["bool"]["must"][0]["query_string"]["query"] = "document:*.html AND useragent:mozilla"
+            query["query"]["bool"]["filter"] = [{"bool": {
+                "should": [{"match_phrase": {"vhost": vhost}} for vhost in vhosts],
+                "minimum_should_match": 1
+            }}]
+        return query
+
+# Bucket on vhost lowercased, so www.Apache.org counts towards www.apache.org
+# in the batch searches just like it does in the single domain one
+def vhostTerms(domains):
+        return {
+                "script": {
+                        "source": "doc['vhost.keyword'].size() == 0 ? '' : doc['vhost.keyword'].value.toLowerCase()",
+                        "lang": "painless"
+                        },
+                "size": len(domains)
+                }
+
+# Most of the aggregations
+def makeAggs():
+        return {
                 "per_day": {
                     "date_histogram": {
                         "field": "@timestamp",
@@ -95,10 +176,292 @@ def makeBook(domain):
                      }
                 }
             }
-        res = es.search(index='loggy-*', request_timeout=90, body = query)
+
+# Geomapping
+# We need to weed out some things here
+GEO_EXCLUDE = {"query_string": {"query": '(geo_country.keyword in ("EU", "AP", "A1", "A2", "SX", "SS", "-")) AND NOT geo_country.keyword:"-"'}}
+def makeGeoAggs():
+        return {
+                "country" : {
+                        "terms" : {
+                                "field" : "geo_country.keyword",
+                                "size" : 200,
+                                "order" : {"_count":"desc"}
+                                }
+                        }
+                }
+
+# Fetch the aggregations for many domains in one search: a terms aggregation
+# on vhost, with the usual aggregations (and the geo one, filtered) under it.
+# Returns {domain: aggregations}, shaped like the per-domain search results
+def batchAggregations(domains, timeout):
+        query = makeQuery(None, vhosts = domains)
+        aggs = makeAggs()
+        aggs["geo"] = {
+                "filter": {"bool": {"must_not": [GEO_EXCLUDE]}},
+                "aggs": makeGeoAggs()
+            }
+        query["aggs"] = {
+                "vhosts": {
+                        "terms": vhostTerms(domains),
+                        "aggs": aggs
+                        }
+                }
+        res = es.search(index='loggy-*', request_timeout=timeout, body = query)
+        results = {}
+        for domain in domains: # Domains with no traffic get no bucket at all
+            results[domain] = {'per_day': {'buckets': []}, 'popular': {'buckets': []}, 'refs': {'buckets': []}, 'country': {'buckets': []}}
+        wanted = dict((domain.lower(), domain) for domain in domains)
+        for bucket in res['aggregations']['vhosts']['buckets']:
+            if bucket['key'] in wanted:
+                bucket['country'] = bucket['geo']['country']
+                results[wanted[bucket['key']]] = bucket
+        return results
+
+class Rollup(object):
+    """ Per-domain, per-day pageviews, unique visitors, top URIs, referrers
+    and countries in sqlite. Only complete (UTC) days are stored; the 30 day
+    views are put together from these plus a fresh search for today.
+    Unique visitors are only ever shown per day, so the daily cardinality
+    from ES is stored as is, no merging needed. """
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread = False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS daily (domain TEXT, day TEXT, pageviews INTEGER, uniques INTEGER, uris TEXT, refs TEXT, countries TEXT, PRIMARY KEY (domain, day))")
+        self.db.commit()
+
+    def days(self):
+        """ The complete days we want to have, oldest first """
+        today = int(time.time() // 86400) * 86400
+        return [strftime("%Y-%m-%d", gmtime(today - n * 86400)) for n in range(ROLLUP_DAYS, 0, -1)]
+
+    def missing(self, domains):
+        """ Returns {domain: the oldest day it has no rollup for, or None} """
+        days = self.days()
+        with self.lock:
+            have = set(self.db.execute("SELECT domain, day FROM daily WHERE day >= ?", (days[0],)).fetchall())
+        missing = {}
+        for domain in domains:
+            missing[domain] = None
+            for day in days:
+                if (domain, day) not in have:
+                    missing[domain] = day
+                    break
+        return missing
+
+    def store(self, domain, day, stats):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO daily VALUES (?, ?, ?, ?, ?, ?, ?)", (
+                domain, day, stats['pageviews'], stats['uniques'],
+                json.dumps(stats['uris']), json.dumps(stats['refs']), json.dumps(stats['countries'])))
+
+    def load(self, domain):
+        """ Returns {day: stats} for the days we have for a domain """
+        with self.lock:
+            rows = self.db.execute("SELECT day, pageviews, uniques, uris, refs, countries FROM daily WHERE domain = ? AND day >= ?", (domain, self.days()[0])).fetchall()
+        return dict((row[0], {
+            'pageviews': row[1],
+            'uniques': row[2],
+            'uris': json.loads(row[3]),
+            'refs': json.loads(row[4]),
+            'countries': json.loads(row[5]),
+            }) for row in rows)
+
+    def commit(self):
+        """ Commits what's been stored, and forgets days we no longer need """
+        with self.lock:
+            self.db.execute("DELETE FROM daily WHERE day < ?", (self.days()[0],))
+            self.db.commit()
+
+
+class DownloadStats(object):
+    """ Downloads per country over the past month, per PMC. The mirror logs
+    only ever grow (until rotated), so for each PMC and mirror we keep the
+    byte offset we've read up to, the ETag, and hourly per-country counts
+    on disk. The next fetch asks for just the bytes past that offset (with
+    If-Range, so a replaced log comes back whole), and streams through
+    them, so a log is never held in memory. Each PMC is fetched at most
+    once per run, however many domains map to it. """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.locks = {}   # pmc -> lock, so two domains don't fetch the same PMC
+        self.results = {} # pmc -> {country: downloads}, for this run
+
+    def countries(self, pmc, deadline):
+        with self.lock:
+            lock = self.locks.setdefault(pmc, threading.Lock())
+        with lock:
+            if pmc not in self.results:
+                totals = {}
+                for mirror in MIRRORS:
+                    for cca, count in self.fetch(pmc, mirror, deadline).items():
+                        totals[cca] = totals.get(cca, 0) + count
+                self.results[pmc] = totals
+            return self.results[pmc]
+
+    def state_file(self, pmc, mirror):
+        where = re.sub(r"[^a-z0-9.]+", "_", mirror.split('//')[-1].replace('%s', '').lower())
+        return os.path.join(self.path, "%s-%s.json" % (re.sub(r"[^a-z0-9_-]+", "_", pmc.lower()), where))
+
+    def fetch(self, pmc, mirror, deadline):
+        """ Brings the cached counts for one mirror log up to date, returns
+        {country: downloads} for the past month """
+        path = self.state_file(pmc, mirror)
+        state = {'etag': None, 'offset': 0, 'hours': {}}
+        try:
+            with open(path) as f:
+                state = json.load(f)
+        except (IOError, OSError, ValueError):
+            pass
+        try:
+            self.update(state, mirror % pmc, deadline)
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            print("Could not update download stats from %s, using what we have: %s" % (mirror % pmc, e))
+
+        # Drop what's gone out of the window, then save and add up the rest
+        oldest = int((time.time() - DOWNLOAD_WINDOW) // 3600)
+        state['hours'] = dict((h, v) for h, v in state['hours'].items() if int(h) >= oldest)
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.rename(path + '.tmp', path)
+        totals = {}
+        for counts in state['hours'].values():
+            for cca, count in counts.items():
+                totals[cca] = totals.get(cca, 0) + count
+        return totals
+
+    def update(self, state, url, deadline):
+        headers = {}
+        if state['offset'] and state['etag']:
+            headers['Range'] = 'bytes=%u-' % state['offset']
+            headers['If-Range'] = state['etag']
+        rv = requests.get(url, headers = headers, stream = True, timeout = deadline.timeout(FETCH_TIMEOUT))
+        try:
+            if rv.status_code == 416:
+                # Nothing past our offset; unless the log got shorter, that's that
+                length = rv.headers.get('Content-Range', '').split('/')[-1]
+                if not length.isdigit() or int(length) >= state['offset']:
+                    return
+                rv.close()
+                state.update({'etag': None, 'offset': 0, 'hours': {}})
+                return self.update(state, url, deadline)
+            if rv.status_code == 200:
+                # Whole log (new, rotated or replaced): start over
+                state.update({'etag': None, 'offset': 0, 'hours': {}})
+            elif rv.status_code != 206:
+                raise Exception("HTTP %u" % rv.status_code)
+            oldest = time.time() - DOWNLOAD_WINDOW
+            carry = b''
+            for chunk in rv.iter_content(65536):
+                lines = (carry + chunk).split(b"\n")
+                carry = lines.pop()
+                for line in lines:
+                    state['offset'] += len(line) + 1
+                    try:
+                        ts, junk, cca, path = line.decode('utf-8', 'replace').split(" ", 3)
+                        ts = int(ts)
+                        if ts >= oldest:
+                            hour = str(ts // 3600)
+                            counts = state['hours'].setdefault(hour, {})
+                            counts[cca] = counts.get(cca, 0) + 1
+                    except ValueError:
+                        pass
+                deadline.timeout(FETCH_TIMEOUT) # give up on big logs when out of time
+            # An unfinished last line is left for the next fetch to pick up
+            state['etag'] = rv.headers.get('ETag') or rv.headers.get('Last-Modified')
+        finally:
+            rv.close()
+
+
+DOWNLOADS = DownloadStats(DOWNLOAD_CACHE)
+
+EMPTY_DAY = {'pageviews': 0, 'uniques': 0, 'uris': {}, 'refs': {}, 'countries': {}}
+
+# Search per-day stats for many domains, from the start of day since (a
+# YYYY-MM-DD string) until now. Returns {domain: {day: stats}}
+def batchDaily(domains, since, timeout):
+        query = makeQuery(None, vhosts = domains)
+        query["query"]["bool"]["must"][1]["range"]["@timestamp"]["gte"] = calendar.timegm(time.strptime(since, "%Y-%m-%d")) * 1000
+        aggs = makeAggs()
+        per_day = aggs.pop("per_day")
+        per_day["date_histogram"]["format"] = "yyyy-MM-dd"
+        aggs["popular"]["terms"]["size"] = ROLLUP_URIS
+        aggs["refs"]["terms"]["size"] = ROLLUP_REFS
+        aggs["uniques"] = per_day["aggs"]["uniques"]
+        aggs["geo"] = {
+                "filter": {"bool": {"must_not": [GEO_EXCLUDE]}},
+                "aggs": makeGeoAggs()
+            }
+        per_day["aggs"] = aggs
+        query["aggs"] = {
+                "vhosts": {
+                        "terms": vhostTerms(domains),
+                        "aggs": {"per_day": per_day}
+                        }
+                }
+        res = es.search(index='loggy-*', request_timeout=timeout, body = query)
+        results = dict((domain, {}) for domain in domains)
+        wanted = dict((domain.lower(), domain) for domain in domains)
+        for vbucket in res['aggregations']['vhosts']['buckets']:
+            if vbucket['key'] not in wanted:
+                continue
+            for el in vbucket['per_day']['buckets']:
+                day = el['key_as_string'][:10]
+                results[wanted[vbucket['key']]][day] = {
+                    'pageviews': el['doc_count'],
+                    'uniques': el['uniques']['value'],
+                    'uris': dict((b['key'], b['doc_count']) for b in el['popular']['buckets']),
+                    'refs': dict((b['key'], b['doc_count']) for b in el['refs']['buckets']),
+                    'countries': dict((b['key'], b['doc_count']) for b in el['geo']['country']['buckets']),
+                }
+        return results
+
+# Turn {day: stats} into aggregations shaped like the ones makeBook searches for
+def composeAggregations(daily):
+        def top(field, size):
+            totals = collections.Counter()
+            for stats in daily.values():
+                totals.update(stats[field])
+            return {'buckets': [{'key': k, 'doc_count': c} for k, c in totals.most_common(size)]}
+        per_day = []
+        for day in sorted(daily):
+            if daily[day]['pageviews']:
+                # Same date format as the @timestamp field, which the searches use
+                per_day.append({'key_as_string': day.replace('-', '/'), 'doc_count': daily[day]['pageviews'], 'uniques': {'value': daily[day]['uniques']}})
+        return {
+            'per_day': {'buckets': per_day},
+            'popular': top('uris', 50),
+            'refs': top('refs', 25),
+            'country': top('countries', 200),
+        }
+
+# Make a "book" (an ODS file)
+def makeBook(domain, deadline = None, aggregations = None):
+        if deadline is None:
+            deadline = Deadline(None, {})
+        book = collections.OrderedDict()
+        
+        if aggregations is None:
+            # This is the global search. We'll adjust as needed
+            query = makeQuery(domain)
+            query['aggs'] = makeAggs()
+            with deadline.phase('search'):
+                res = es.search(index='loggy-*', request_timeout=deadline.timeout(SEARCH_TIMEOUT), body = query)
+            aggregations = res['aggregations']
+            
+            query["query"]["bool"]["must_not"].append(GEO_EXCLUDE)
+            query["aggs"] = makeGeoAggs()
+            with deadline.phase('geo'):
+                res = es.search(index='loggy-*', request_timeout=deadline.timeout(SEARCH_TIMEOUT), body = query)
+            aggregations['country'] = res['aggregations']['country']
         
         arr = [['Date', 'Unique visitors']]
-        for el in res['aggregations']['per_day']['buckets']:
+        for el in aggregations['per_day']['buckets']:
                 d = el['key_as_string'].replace(' 00:00:00', '')
                 c = el['uniques']['value']
                 arr.append([d,c])
@@ -107,7 +470,7 @@ def makeBook(domain):
         
         
         arr = [['Date', 'Pageviews']]
-        for el in res['aggregations']['per_day']['buckets']:
+        for el in aggregations['per_day']['buckets']:
                 d = el['key_as_string'].replace(' 00:00:00', '')
                 c = el['doc_count']
                 arr.append([d,c])
@@ -116,7 +479,7 @@ def makeBook(domain):
         
         
         arr = [['URI', 'Pageviews']]
-        for el in res['aggregations']['popular']['buckets']:
+        for el in aggregations['popular']['buckets']:
                 d = el['key']
                 c = el['doc_count']
                 arr.append([d,c])
@@ -125,7 +488,7 @@ def makeBook(domain):
         
         
         arr = [['Referrer', 'Pageviews']]
-        for el in res['aggregations']['refs']['buckets']:
+        for el in aggregations['refs']['buckets']:
                 d = el['key']
                 c = el['doc_count']
                 # We only use it if > 10 people have used it, so as to not divulge PII
@@ -135,22 +498,8 @@ def makeBook(domain):
         
         
         
-        # Geomapping
-        # We need to weed out some things here
-        query["query"]["bool"]["must_not"].append({"query_string": {"query": '(geo_country.keyword in ("EU", "AP", "A1", "A2", "SX", "SS", "-")) AND NOT geo_country.keyword:"-"'}})
-        query["aggs"] = {
-                "country" : {
-                        "terms" : {
-                                "field" : "geo_country.keyword",
-                                "size" : 200,
-                                "order" : {"_count":"desc"}
-                                }
-                        }
-                }
-        res = es.search(index='loggy-*', request_timeout=90, body = query)
-        
         arr = [['Country', 'Pageviews']]
-        for el in res['aggregations']['country']['buckets']:
+        for el in aggregations['country']['buckets']:
                 if el['key'] != '-':
                         d = el['key']
                         c = el['doc_count']
@@ -159,32 +508,24 @@ def makeBook(domain):
         
         try:
             if domain in LDAPMAP:
-                lines = []
                 pmc = LDAPMAP[domain]
                 print("Fetching download stats for %s..." % pmc)
-                eu = requests.get('http://www.eu.apache.org/dyn/stats/%s.log' % pmc)
-                us = requests.get('http://www.us.apache.org/dyn/stats/%s.log' % pmc)
-                if eu.status_code == 200:
-                    lines += eu.text.split("\n")
-                if us.status_code == 200:
-                    lines += us.text.split("\n")
-                cdownloads = {}
-                now = time.time()
-                for line in lines:
-                    try:
-                        ts, junk, cca, path = line.split(" ", 3)
-                        ts = int(ts)
-                        if (ts + (30*86400)) >= now:
-                            cdownloads[cca] = cdownloads.get(cca, 0) + 1
-                    except:
-                        pass
+                with deadline.phase('downloads'):
+                    cdownloads = DOWNLOADS.countries(pmc, deadline)
                 arr = [['Country', 'Downloads']]
                 for k, v in cdownloads.items():
                     arr.append([k.upper(), v])
                 book.update({'Downloads, past month': arr})
+        except DeadlineExceeded:
+            raise
         except Exception as e:
             print(e)
 
+        with deadline.phase('export'):
+            exportBook(domain, book)
+
+
+def exportBook(domain, book):
         pyexcel_ods.save_data("%s/%s.ods" % (EXPORTS, domain), book)
 
 #       Convert to YAML
@@ -211,11 +552,166 @@ def makeBook(domain):
             dump_yaml(booky, wy)
 
 
+class Runner(object):
+    """ Charts domains on a pool of worker threads. Each domain gets a
+    deadline and a few attempts; finished domains are written to PROGRESS,
+    so a rerun after a crash only does the ones still missing. """
+    def __init__(self, workers = 8, deadline = 600, retries = 2, resume = True, batch = 50, rollup = None):
+        self.workers = workers
+        self.batch = batch
+        self.rollup = rollup
+        self.aggregations = {}
+        self.batches = []
+        self.deadline = deadline
+        self.retries = retries
+        self.resume = resume
+        self.lock = threading.Lock()
+        self.results = {}
+        self.progress = {'started': time.time(), 'done': []}
+
+    def load_progress(self):
+        try:
+            with open(PROGRESS) as f:
+                progress = json.load(f)
+            if progress['started'] >= time.time() - RESUME_WINDOW:
+                self.progress = progress
+                print("Resuming run from %s, %u domains already done" % (strftime("%Y-%m-%d %H:%M", gmtime(progress['started'])), len(progress['done'])))
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+
+    def save_progress(self):
+        tmp = PROGRESS + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.progress, f)
+        os.rename(tmp, PROGRESS)
+
+    def chart(self, domain):
+        timings = {}
+        result = {'status': 'failed', 'attempts': 0, 'timings': timings}
+        start = time.time()
+        for attempt in range(1, self.retries + 2):
+            result['attempts'] = attempt
+            print("Charting %s" % domain)
+            try:
+                left = max(self.deadline - (time.time() - start), 0.001) if self.deadline else None
+                makeBook(domain, Deadline(left, timings), self.aggregations.get(domain))
+                result['status'] = 'ok'
+                break
+            except DeadlineExceeded as e:
+                result['error'] = str(e)
+                break
+            except Exception as e:
+                result['error'] = str(e)
+                print("Charting %s failed (attempt %u): %s" % (domain, attempt, e))
+                if attempt > self.retries or (self.deadline and time.time() - start >= self.deadline):
+                    break
+                time.sleep(min(2 ** attempt, 30))
+        result['took'] = time.time() - start
+        with self.lock:
+            self.results[domain] = result
+            if result['status'] == 'ok' and self.resume:
+                self.progress['done'].append(domain)
+                self.save_progress()
+        return result
+
+    def prefetch(self, domains):
+        """ Runs the batch searches for a chunk of domains. If it fails, those
+        domains just do their own searches. """
+        start = time.time()
+        try:
+            if self.rollup:
+                aggregations = self.rolled_up(domains)
+            else:
+                aggregations = batchAggregations(domains, BATCH_TIMEOUT)
+            with self.lock:
+                self.aggregations.update(aggregations)
+        except Exception as e:
+            print("Batch search for %u domains failed, they'll be searched one by one: %s" % (len(domains), e))
+        with self.lock:
+            self.batches.append(time.time() - start)
+
+    def rolled_up(self, domains):
+        """ Searches the days the rollup is missing (usually just yesterday)
+        plus today, stores the complete days and composes the 30 day views """
+        today = strftime("%Y-%m-%d", gmtime())
+        # Domains new to the rollup need all 30 days, the rest don't
+        groups = {}
+        for domain, since in self.rollup.missing(domains).items():
+            groups.setdefault(since or today, []).append(domain)
+        aggregations = {}
+        for since, group in groups.items():
+            daily = batchDaily(group, since, BATCH_TIMEOUT)
+            for domain in group:
+                for day in self.rollup.days():
+                    if day >= since:
+                        self.rollup.store(domain, day, daily[domain].get(day, EMPTY_DAY))
+                stats = self.rollup.load(domain)
+                stats[today] = daily[domain].get(today, EMPTY_DAY)
+                aggregations[domain] = composeAggregations(stats)
+        self.rollup.commit()
+        return aggregations
+
+    def run(self, domains):
+        if self.resume:
+            self.load_progress()
+            done = set(self.progress['done'])
+            domains = [d for d in domains if d not in done]
+        start = time.time()
+        with concurrent.futures.ThreadPoolExecutor(max_workers = self.workers) as pool:
+            if self.batch:
+                chunks = [domains[i:i+self.batch] for i in range(0, len(domains), self.batch)]
+                list(pool.map(self.prefetch, chunks))
+            list(pool.map(self.chart, domains))
+        self.summary(time.time() - start)
+        failed = [d for d, r in self.results.items() if r['status'] != 'ok']
+        if self.resume and not failed and os.path.exists(PROGRESS):
+            os.unlink(PROGRESS) # All done, the next run starts afresh
+        return failed
+
+    def summary(self, took):
+        phases = collections.OrderedDict()
+        for result in self.results.values():
+            for phase, spent in result['timings'].items():
+                phases[phase] = phases.get(phase, 0) + spent
+        ok = sum(1 for r in self.results.values() if r['status'] == 'ok')
+        print("Charted %u of %u domains in %.1fs with %u workers" % (ok, len(self.results), took, self.workers))
+        if self.batches:
+            print("  %-10s %8.1fs (%u searches covering %u domains)" % ('batch', sum(self.batches), len(self.batches), len(self.aggregations)))
+        for phase, spent in phases.items():
+            print("  %-10s %8.1fs" % (phase, spent))
+        print("Slowest domains:")
+        slowest = sorted(self.results.items(), key = lambda x: x[1]['took'], reverse = True)
+        for domain, result in slowest[:20]:
+            spent = ", ".join("%s %.1fs" % (k, v) for k, v in result['timings'].items())
+            print("  %-40s %6.1fs  %s (%u attempts) %s" % (domain, result['took'], result['status'], result['attempts'], spent))
+        for domain, result in sorted(self.results.items()):
+            if result['status'] != 'ok':
+                print("  FAILED: %s: %s" % (domain, result.get('error')))
+
+
 if __name__ == '__main__':
-    if sys.argv[1:]: # If arguments provided, then process only those (for testing)
-        for sdomain in sys.argv[1:]:
-            print("Charting %s" % sdomain)
-            makeBook(sdomain)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("domains", nargs = '*', help = "Only chart these domains (for testing)")
+    parser.add_argument("--workers", type = int, default = 8, help = "Number of domains to chart at once")
+    parser.add_argument("--deadline", type = int, default = 600, help = "Give up on a domain after this many seconds")
+    parser.add_argument("--retries", type = int, default = 2, help = "Retry a failed domain this many times")
+    parser.add_argument("--no-resume", action = 'store_true', help = "Don't pick up where an interrupted run left off")
+    parser.add_argument("--batch", type = int, default = 50, help = "Domains per batched ES search (0 to search each domain separately)")
+    parser.add_argument("--no-rollup", action = 'store_true', help = "Search all 30 days instead of using the daily rollups")
+    args = parser.parse_args()
+
+    # One pooled ES connection per worker
+    es = elasticsearch.Elasticsearch([
+            {'host': 'localhost', 'port': 9200, 'url_prefix': '', 'use_ssl': False},
+    ], maxsize = args.workers)
+
+    rollup = None
+    if args.batch and not args.no_rollup:
+        rollup = Rollup(ROLLUP)
+
+    if args.domains: # If arguments provided, then process only those (for testing)
+        runner = Runner(args.workers, args.deadline, args.retries, resume = False, batch = args.batch, rollup = rollup)
+        runner.run(args.domains)
     else:
         
         # Clean up stale files (more than a week old)
@@ -249,8 +745,6 @@ if __name__ == '__main__':
             if cmt['status'] == "current" and subdomain not in subdomains:
                 subdomains.append(subdomain)
                 
-        for sdomain in sorted(subdomains):
-                if sdomain:
-                        print("Charting %s" % sdomain)
-                        makeBook(sdomain)
+        runner = Runner(args.workers, args.deadline, args.retries, resume = not args.no_resume, batch = args.batch, rollup = rollup)
+        runner.run([sdomain for sdomain in sorted(subdomains) if sdomain])
     print("All done")